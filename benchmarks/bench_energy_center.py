@@ -0,0 +1,32 @@
+"""
+Time autodetect.energy_center against the pixel by pixel version it replaced,
+on an image the size of face_and_energy_detector's working image.
+
+Run from the project root, with the same TRANSMOGRIFY_* environment as the
+tests::
+
+    PYTHONPATH=. python benchmarks/bench_energy_center.py
+"""
+import os
+import timeit
+
+from PIL import Image
+
+from benchmarks.reference import energy_center_by_pixel
+from transmogrify import autodetect, settings
+
+
+def main():
+    img = Image.open(os.path.join(settings.ORIG_BASE_PATH, 'horiz_img.jpg'))
+    img = img.convert('L', (0.5, 0.419, 0.081, 0)).resize((800, 555))
+
+    by_pixel = min(timeit.repeat(lambda: energy_center_by_pixel(img), number=1, repeat=3))
+    vectorized = min(timeit.repeat(lambda: autodetect.energy_center(img), number=10, repeat=3)) / 10
+    print "energy_center on %sx%s" % img.size
+    print "  pixel by pixel: %8.2f ms" % (by_pixel * 1000)
+    print "  numpy:          %8.2f ms" % (vectorized * 1000)
+    print "  speedup:        %8.1fx" % (by_pixel / vectorized)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Time images2gif.NeuQuant against the element by element port it replaced,
+learning the palette of a full size test image, one sample at a time and in
+batches.
+
+Run from the project root, with the same TRANSMOGRIFY_* environment as the
+tests::
+
+    PYTHONPATH=. python benchmarks/bench_neuquant.py
+"""
+import os
+import timeit
+
+from PIL import Image
+
+from benchmarks.reference import ElementwiseNeuQuant
+from transmogrify import images2gif, settings
+
+
+def main(samplefac=10, batch_size=64):
+    img = Image.open(os.path.join(settings.ORIG_BASE_PATH, 'horiz_img.jpg')).convert('RGBA')
+
+    elementwise = min(timeit.repeat(lambda: ElementwiseNeuQuant(img, samplefac), number=1, repeat=3))
+    vectorized = min(timeit.repeat(lambda: images2gif.NeuQuant(img, samplefac), number=1, repeat=3))
+    batched = min(timeit.repeat(lambda: images2gif.NeuQuant(img, samplefac, batch_size=batch_size),
+                                number=1, repeat=3))
+    nq = images2gif.NeuQuant(img, samplefac)
+    without_scipy = min(timeit.repeat(lambda: nq.quantize_without_scipy(img), number=1, repeat=3))
+    print "NeuQuant learning on %sx%s, samplefac %s" % (img.size + (samplefac, ))
+    print "  element by element: %8.2f ms" % (elementwise * 1000)
+    print "  numpy:              %8.2f ms" % (vectorized * 1000)
+    print "  speedup:            %8.1fx" % (elementwise / vectorized)
+    print "  batches of %-8s %8.2f ms" % (str(batch_size) + ':', batched * 1000)
+    print "  speedup:            %8.1fx" % (elementwise / batched)
+    print "  quantize_without_scipy: %8.2f ms" % (without_scipy * 1000)
+
+
+if __name__ == '__main__':
+    main()
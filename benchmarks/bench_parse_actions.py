@@ -0,0 +1,38 @@
+"""
+Time parsing the actions from requested filenames, checking each action with
+its processor's pattern as before, against the combined grammar and the cache
+of parsed filenames.
+
+Run from the project root, with the same TRANSMOGRIFY_* environment as the
+tests::
+
+    PYTHONPATH=. python benchmarks/bench_parse_actions.py
+"""
+import timeit
+
+from benchmarks.reference import FILENAMES, parse_action_tuples_by_token
+from transmogrify import utils
+
+
+def parse_uncached():
+    grammar, _ = utils.get_action_parser()
+    for filename in FILENAMES:
+        utils.parse_action_string(filename, grammar)
+
+
+def main():
+    number = 2000
+    by_token = min(timeit.repeat(lambda: [parse_action_tuples_by_token(f) for f in FILENAMES],
+                                 number=number, repeat=3))
+    grammar = min(timeit.repeat(parse_uncached, number=number, repeat=3))
+    cached = min(timeit.repeat(lambda: [utils.parse_action_tuples(f) for f in FILENAMES],
+                               number=number, repeat=3))
+    per_filename = 1e6 / (number * len(FILENAMES))
+    print "parse_action_tuples, per filename"
+    print "  pattern per action: %8.2f us" % (by_token * per_filename)
+    print "  combined grammar:   %8.2f us" % (grammar * per_filename)
+    print "  cached:             %8.2f us" % (cached * per_filename)
+
+
+if __name__ == '__main__':
+    main()
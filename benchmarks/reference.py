@@ -0,0 +1,220 @@
+"""
+The implementations that the optimized code replaced, for the benchmarks to
+time against and the tests to check the new code still gives the same results.
+"""
+import os
+import re
+
+import numpy as np
+
+from transmogrify import images2gif
+
+FILENAMES = [
+    "horiz_img.jpg",
+    "horiz_img_r300x300.jpg",
+    "img/photos/2008/05/12/WIZARDS_0034_05022035_r329x151.jpg",
+    "WIZARDS_0034_05022035_c0-0-100-100_r329x151_fBLUR.jpg",
+    "horiz_img_l100x200-ff00cc_b3-000000_fSmooth_a300x200.png",
+    "horiz_img_c1088_c0-0-100-100.jpg",
+    "horiz_img_fedge_enhance_more.jpg",
+    "horiz_img_x100_r.jpg",
+    "horiz_img__t100.jpg",
+    "horiz_img_\xc2\xa7.png",
+    "c1088-1_1.jpg",
+    "c1088.jpg",
+]
+
+
+def parse_action_tuples_by_token(filename):
+    """
+    Parse the actions by checking each with its processor's own pattern
+    """
+    from transmogrify.settings import PROCESSORS
+    base_filename, ext = os.path.splitext(filename)
+    action_tuples = []
+    bits = re.split("(_)", base_filename)
+    while bits:
+        action = bits.pop()
+        if len(action) < 1:
+            continue
+        code, arg = action[0], action[1:]
+        if code in PROCESSORS and PROCESSORS[code].param_pattern().match(arg):
+            action_tuples.insert(0, (code, arg))
+            if bits and bits[-1] == '_':
+                bits.pop()
+        else:
+            bits.append(action)
+            break
+    return "".join(bits), action_tuples
+
+
+def energy_center_by_pixel(image):
+    """
+    The original, pixel by pixel, calculation of energy_center
+    """
+    width, height = image.size
+    min_val, max_val = image.getextrema()
+    threshold = min(max(0, max_val - 1), 200)
+    accum = 0
+    accum_x = 0
+    accum_y = 0
+    for y in range(height):
+        for x in range(width):
+            value = image.getpixel((x, y))
+            if value > threshold:
+                value -= threshold
+                dvalue = (value * value) / float(255 * 255)
+                accum += dvalue
+                accum_x += x * dvalue
+                accum_y += y * dvalue
+    if accum:
+        cx = accum_x / accum
+        cy = accum_y / accum
+    else:
+        cx = width / 2
+        cy = height / 2
+    return (cx / float(width), cy / float(height))
+
+
+class ElementwiseNeuQuant(images2gif.NeuQuant):
+    """
+    The original NeuQuant port, which learned element by element
+    """
+    def altersingle(self, alpha, i, b, g, r):
+        n = self.network[i]
+        n[0] -= (alpha * (n[0] - b))
+        n[1] -= (alpha * (n[1] - g))
+        n[2] -= (alpha * (n[2] - r))
+
+    def geta(self, alpha, rad):
+        try:
+            return self.a_s[(alpha, rad)]
+        except KeyError:
+            length = rad * 2 - 1
+            mid = length / 2
+            q = np.array(list(range(mid - 1, -1, -1)) + list(range(-1, mid)))
+            a = alpha * (rad * rad - q * q) / (rad * rad)
+            a[mid] = 0
+            self.a_s[(alpha, rad)] = a
+            return a
+
+    def alterneigh(self, alpha, rad, i, b, g, r):
+        if i - rad >= self.SPECIALS - 1:
+            lo = i - rad
+            start = 0
+        else:
+            lo = self.SPECIALS - 1
+            start = (self.SPECIALS - 1 - (i - rad))
+
+        if i + rad <= self.NETSIZE:
+            hi = i + rad
+            end = rad * 2 - 1
+        else:
+            hi = self.NETSIZE
+            end = (self.NETSIZE - (i + rad))
+
+        a = self.geta(alpha, rad)[start:end]
+
+        p = self.network[lo + 1:hi]
+        p -= np.transpose(np.transpose(p - np.array([b, g, r])) * a)
+
+    def contest(self, b, g, r):
+        i, j = self.SPECIALS, self.NETSIZE
+        dists = abs(self.network[i:j] - np.array([b, g, r])).sum(1)
+        bestpos = i + np.argmin(dists)
+        biasdists = dists - self.bias[i:j]
+        bestbiaspos = i + np.argmin(biasdists)
+        self.freq[i:j] *= (1 - self.BETA)
+        self.bias[i:j] += self.BETAGAMMA * self.freq[i:j]
+        self.freq[bestpos] += self.BETA
+        self.bias[bestpos] -= self.BETAGAMMA
+        return bestbiaspos
+
+    def learn(self):
+        bias_radius = self.INITBIASRADIUS
+        alphadec = 30 + ((self.samplefac - 1) / 3)
+        lengthcount = self.pixels.size
+        samplepixels = lengthcount / self.samplefac
+        delta = samplepixels / self.NCYCLES
+        alpha = self.INITALPHA
+
+        rad = bias_radius >> self.RADIUSBIASSHIFT
+        if rad <= 1:
+            rad = 0
+
+        pos = 0
+        if lengthcount % self.PRIME1 != 0:
+            step = self.PRIME1
+        elif lengthcount % self.PRIME2 != 0:
+            step = self.PRIME2
+        elif lengthcount % self.PRIME3 != 0:
+            step = self.PRIME3
+        else:
+            step = self.PRIME4
+
+        i = 0
+        while i < samplepixels:
+            p = self.pixels[pos]
+            r = (p >> 16) & 0xff
+            g = (p >> 8) & 0xff
+            b = (p) & 0xff
+
+            if i == 0:  # Remember background colour
+                self.network[self.BGCOLOR] = [b, g, r]
+
+            j = self.special_find(b, g, r)
+            if j < 0:
+                j = self.contest(b, g, r)
+
+            if j >= self.SPECIALS:  # Don't learn for specials
+                a = (1.0 * alpha) / self.INITALPHA
+                self.altersingle(a, j, b, g, r)
+                if rad > 0:
+                    self.alterneigh(a, rad, j, b, g, r)
+
+            pos = (pos + step) % lengthcount
+
+            i += 1
+            if i % delta == 0:
+                alpha -= alpha / alphadec
+                bias_radius -= bias_radius / self.RADIUSDEC
+                rad = bias_radius >> self.RADIUSBIASSHIFT
+                if rad <= 1:
+                    rad = 0
+
+    def fix(self):
+        for i in range(self.NETSIZE):
+            for j in range(3):
+                x = int(0.5 + self.network[i, j])
+                x = max(0, x)
+                x = min(255, x)
+                self.colormap[i, j] = x
+            self.colormap[i, 3] = i
+
+    def inxbuild(self):
+        previouscol = 0
+        startpos = 0
+        for i in range(self.NETSIZE):
+            p = self.colormap[i]
+            q = None
+            smallpos = i
+            smallval = p[1]
+            for j in range(i + 1, self.NETSIZE):
+                q = self.colormap[j]
+                if q[1] < smallval:
+                    smallpos = j
+                    smallval = q[1]
+
+            q = self.colormap[smallpos]
+            if i != smallpos:
+                p[:], q[:] = q, p.copy()
+
+            if smallval != previouscol:
+                self.netindex[previouscol] = (startpos + i) >> 1
+                for j in range(previouscol + 1, smallval):
+                    self.netindex[j] = i
+                previouscol = smallval
+                startpos = i
+        self.netindex[previouscol] = (startpos + self.MAXNETPOS) >> 1
+        for j in range(previouscol + 1, 256):
+            self.netindex[j] = self.MAXNETPOS
@@ -16,3 +16,19 @@ group = "www-data"
 accesslog = "/var/log/gunicorn/%s.access.log" % NAME
 errorlog = "/var/log/gunicorn/%s.error.log" % NAME
 proc_name = NAME
+
+
+def post_fork(server, worker):
+    # Load the face detection classifier before the first request
+    from transmogrify import autodetect
+    autodetect.preload()
+
+    # Don't share S3 connections with the master process
+    from transmogrify.filesystem import s3
+    s3.reset()
+
+
+def worker_exit(server, worker):
+    # Save the images still queued to be saved
+    from transmogrify import writeback
+    writeback.flush()
@@ -54,7 +54,7 @@ setup(
     ],
     install_requires=read_file('requirements.txt'),
     include_package_data=True,
-    packages=find_packages(exclude=['example*', ]),
+    packages=find_packages(exclude=['example*', 'benchmarks*', ]),
     scripts=['bin/configure_transmogrify'],
     zip_safe=False
 )
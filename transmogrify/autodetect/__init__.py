@@ -1,6 +1,11 @@
+import Queue
+import threading
 from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
 from PIL import Image, ImageFilter, ImageChops
 from transmogrify.settings import OPENCV_PREFIX
+from .cache import GravityCache
 
 try:
     import cv2
@@ -62,36 +67,145 @@ class CropInfo(object):
         )
 
 
+def get_image(image):
+    """
+    Return a PIL image, opening it if ``image`` is a path
+    """
+    if isinstance(image, basestring):
+        return Image.open(image)
+    return image
+
+
+def to_grayscale_array(image):
+    """
+    Return a path, PIL image, or BGR array as a grayscale array for OpenCV
+    """
+    if isinstance(image, np.ndarray):
+        if image.ndim == 3:
+            return cv2.cvtColor(image, cv.CV_BGR2GRAY)
+        return image
+    return np.asarray(get_image(image).convert('L'))
+
+
+def get_working_array(image, max_width=None):
+    """
+    Return a grayscale array of the image, scaled down to no wider than
+    ``max_width``, and the scale it was reduced by.
+
+    ``image`` may be a path, PIL image, or BGR array.
+    """
+    if isinstance(image, np.ndarray):
+        img_gray = to_grayscale_array(image)
+        height, width = img_gray.shape
+        if not max_width or width <= max_width:
+            return img_gray, 1.0
+        scale = float(max_width) / width
+        size = (max_width, max(int(round(height * scale)), 1))
+        return cv2.resize(img_gray, size, interpolation=cv2.INTER_AREA), scale
+
+    img = get_image(image).convert('L')
+    width, height = img.size
+    if not max_width or width <= max_width:
+        return np.asarray(img), 1.0
+    scale = float(max_width) / width
+    size = (max_width, max(int(round(height * scale)), 1))
+    return np.asarray(img.resize(size, Image.BICUBIC)), scale
+
+
+class ClassifierPool(object):
+    """
+    Classifiers made by ``factory``, each used by one thread at a time as they
+    aren't thread safe. Another is made whenever every one is in use, so
+    threads detecting at once don't wait for each other.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.idle = Queue.LifoQueue()
+
+    @contextmanager
+    def classifier(self):
+        """
+        Check out a classifier for the duration of the ``with`` block
+        """
+        try:
+            classifier = self.idle.get_nowait()
+        except Queue.Empty:
+            classifier = self.factory()
+        try:
+            yield classifier
+        finally:
+            self.idle.put(classifier)
+
+    def preload(self):
+        """
+        Make the first classifier now, if there isn't one
+        """
+        if self.idle.empty():
+            self.idle.put(self.factory())
+
+
 if HAS_OPENCV:
-    def find_faces(img_path, cascade_fn=DEFAULT_CASCADE_FN,
+    cascades = {}
+    cascades_lock = threading.Lock()
+
+    def get_cascade(cascade_fn=DEFAULT_CASCADE_FN):
+        """
+        Return the ``ClassifierPool`` of classifiers for ``cascade_fn``.
+
+        The cascade file is only parsed when the pool needs another classifier.
+        """
+        with cascades_lock:
+            if cascade_fn not in cascades:
+                cascades[cascade_fn] = ClassifierPool(lambda: cv2.CascadeClassifier(cascade_fn))
+            return cascades[cascade_fn]
+
+    def find_faces(image, cascade_fn=DEFAULT_CASCADE_FN,
                scaleFactor=1.3, minNeighbors=4, minSize=(20, 20),
-               flags=DEFAULT_FLAGS):
-        img_color = cv2.imread(img_path)
-        img_gray = cv2.cvtColor(img_color, cv.CV_BGR2GRAY)
+               flags=DEFAULT_FLAGS, max_width=None):
+        """
+        Return the (left, top, right, bottom) of the faces found in the image.
+
+        Detection runs on a copy no wider than ``max_width`` (by default
+        FACE_DETECTION_WIDTH), but the rectangles are in the image's own
+        coordinates.
+        """
+        from transmogrify.settings import FACE_DETECTION_WIDTH
+
+        if max_width is None:
+            max_width = FACE_DETECTION_WIDTH
+        img_gray, scale = get_working_array(image, max_width)
         img_gray = cv2.equalizeHist(img_gray)
-        cascade = cv2.CascadeClassifier(cascade_fn)
-        rects = cascade.detectMultiScale(img_gray, scaleFactor=scaleFactor,
-                                         minNeighbors=minNeighbors,
-                                         minSize=minSize, flags=flags)
+        with get_cascade(cascade_fn).classifier() as cascade:
+            rects = cascade.detectMultiScale(img_gray, scaleFactor=scaleFactor,
+                                             minNeighbors=minNeighbors,
+                                             minSize=minSize, flags=flags)
 
         if len(rects) == 0:
             return []
         rects[:, 2:] += rects[:, :2]
+        if scale != 1.0:
+            rects = (rects / scale).round().astype(rects.dtype)
         return rects
 
-    def do_face_detection(img_path, cascade_fn=DEFAULT_CASCADE_FN,
+    def do_face_detection(image, cascade_fn=DEFAULT_CASCADE_FN,
                scaleFactor=1.3, minNeighbors=4, minSize=(20, 20),
-               flags=DEFAULT_FLAGS):
+               flags=DEFAULT_FLAGS, max_width=None):
+        """
+        Return the relative (x, y) center of the faces in the image, or []
+        """
+        from transmogrify.settings import FACE_DETECTION_WIDTH
 
+        if max_width is None:
+            max_width = FACE_DETECTION_WIDTH
         centers = []
-        rects = find_faces(img_path, cascade_fn, scaleFactor, minNeighbors, minSize, flags)
+        # Gravity is relative, so there is no need to scale the faces back up
+        img_gray, scale = get_working_array(image, max_width)
+        rects = find_faces(img_gray, cascade_fn, scaleFactor, minNeighbors, minSize, flags, max_width=0)
         for rect in rects:
             centers.append(Rect(*rect).center)
         x = [x[0] for x in centers]
         y = [y[1] for y in centers]
-        dims = cv2.imread(img_path).shape  # height, width, maybe color depth
-        w = dims[1]
-        h = dims[0]
+        h, w = img_gray.shape
         if centers:
             return ((sum(x) / len(x)) / float(w), (sum(y) / len(y)) / float(h))
         return []
@@ -103,46 +217,50 @@ else:
         return []
 
 
+def preload(cascade_fn=DEFAULT_CASCADE_FN):
+    """
+    Load the face detection classifier now, so the first request doesn't have
+    to. Call it from gunicorn's ``post_fork`` hook, for example.
+    """
+    if HAS_OPENCV:
+        get_cascade(cascade_fn).preload()
+
+
 def energy_center(image):
+    """
+    Return the relative (x, y) center of the image's energy: the pixels above
+    a brightness threshold, weighted by the square of how far above it they are.
+    """
     width, height = image.size
     if not image.mode == 'L':
         temp_image = image.convert('L', (0.5, 0.419, 0.081, 0))
     else:
-        temp_image = image.copy()
+        temp_image = image
     min_val, max_val = temp_image.getextrema()
     threshold = min(max(0, max_val - 1), 200)
-    accum = 0
-    accumX = 0
-    accumY = 0
-    dvalue = 0
-    for y in range(height):
-        for x in range(width):
-            value = temp_image.getpixel((x, y))
-            if value > threshold:
-                value -= threshold
-                dvalue = (value * value) / float(255 * 255)
-                accum += dvalue
-                accumX += x * dvalue
-                accumY += y * dvalue
+    values = np.asarray(temp_image, dtype=np.float64) - threshold
+    values[values < 0] = 0
+    energy = (values * values) / float(255 * 255)
+    accum = energy.sum()
     if accum:
-        cx = accumX / accum
-        cy = accumY / accum
+        cx = (energy.sum(axis=0) * np.arange(width)).sum() / accum
+        cy = (energy.sum(axis=1) * np.arange(height)).sum() / accum
     else:
         cx = width / 2
         cy = height / 2
-    return (cx / float(width), cy / float(height))
+    return (float(cx) / width, float(cy) / height)
 
 
-def face_and_energy_detector(image_path, detect_faces=True):
+def face_and_energy_detector(image, detect_faces=True):
     """
-    Finds faces and energy in an image
+    Finds faces and energy in an image, a PIL image or a path to one
     """
-    source = Image.open(image_path)
+    source = get_image(image)
     work_width = 800
-    if source.mode != 'RGB' or source.bits != 8:
+    if source.mode != 'RGB' or getattr(source, 'bits', 8) != 8:
         source24 = source.convert('RGB')
     else:
-        source24 = source.copy()
+        source24 = source
 
     grayscaleRMY = source24.convert('L', (0.5, 0.419, 0.081, 0))
     w = min(grayscaleRMY.size[0], work_width)
@@ -150,7 +268,7 @@ def face_and_energy_detector(image_path, detect_faces=True):
     b = grayscaleRMY.resize((w, h), Image.BICUBIC)
     # b.save('step2.jpg')
     if detect_faces:
-        info = do_face_detection(image_path)
+        info = do_face_detection(source24)
         if info:
             return CropInfo(gravity=info)
     b = b.filter(ImageFilter.GaussianBlur(7))
@@ -209,13 +327,40 @@ def calc_subrange(range_max, sub_amount, weight):
         return (0, sub_amount)
 
 
-def smart_crop(crop_w, crop_h, image_path):
+gravity_cache = None
+
+
+def get_gravity_cache():
+    """
+    Return the GravityCache set up in GRAVITY_CACHE, or None if it is off
+    """
+    global gravity_cache
+    from transmogrify.settings import GRAVITY_CACHE
+
+    if not GRAVITY_CACHE:
+        return None
+    if gravity_cache is None or gravity_cache.path != GRAVITY_CACHE:
+        gravity_cache = GravityCache(GRAVITY_CACHE)
+    return gravity_cache
+
+
+def smart_crop(crop_w, crop_h, image, cache_key=None):
     """
-    Return the scaled image size and crop rectangle
+    Return the scaled image size and crop rectangle for a PIL image, or a path
+    to one
+
+    If ``cache_key`` identifies the image, its gravity is kept in the
+    GRAVITY_CACHE for the next time.
     """
-    cropping = face_and_energy_detector(image_path)
-    img = Image.open(image_path)
-    w, h = img.size
+    img = get_image(image)
+    cache = get_gravity_cache() if cache_key else None
+    gravity = cache.get(cache_key) if cache else None
+    if gravity is not None:
+        cropping = CropInfo(gravity=gravity)
+    else:
+        cropping = face_and_energy_detector(img)
+        if cache:
+            cache.set(cache_key, cropping.gravity)
     scaled_size = get_crop_size(crop_w, crop_h, *img.size)
     gravity_x = int(round(scaled_size[0] * cropping.gravity[0]))
     gravity_y = int(round(scaled_size[1] * cropping.gravity[1]))
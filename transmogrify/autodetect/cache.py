@@ -0,0 +1,59 @@
+"""
+A cache of the gravity detected for original images, kept in SQLite so every
+worker can share it.
+"""
+import os
+import sqlite3
+import logging
+import threading
+import daiquiri
+
+daiquiri.setup(level=logging.INFO)
+logger = daiquiri.getLogger(__name__)
+
+
+class GravityCache(object):
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        """
+        A connection for this thread. SQLite connections can't be shared
+        between threads, or carried over a fork.
+        """
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS gravity "
+                    "(key TEXT PRIMARY KEY, x REAL, y REAL)")
+            self.local.connection = connection
+            self.local.pid = pid
+        return self.local.connection
+
+    def get(self, key):
+        """
+        Return the (x, y) gravity for ``key``, or ``None``
+        """
+        try:
+            row = self.connection.execute(
+                "SELECT x, y FROM gravity WHERE key = ?", (key, )).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Couldn't read the gravity cache: {0}".format(e))
+            return None
+        if row is None:
+            return None
+        return tuple(row)
+
+    def set(self, key, gravity):
+        try:
+            with self.connection as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO gravity (key, x, y) VALUES (?, ?, ?)",
+                    (key, gravity[0], gravity[1]))
+        except sqlite3.Error as e:
+            logger.warning("Couldn't write to the gravity cache: {0}".format(e))
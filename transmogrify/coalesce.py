@@ -0,0 +1,133 @@
+"""
+Coalesce concurrent requests for the same image, so it is only rendered once.
+
+Within a worker, requests wait on the thread doing the rendering and get its
+result. Across workers, the rendering thread holds an ``fcntl`` lock on a file
+in ``LOCK_DIR``. Other workers wait for that lock, and then find the image
+already saved at its usual path.
+"""
+import os
+import time
+import errno
+import fcntl
+import threading
+from hashlib import sha1
+from contextlib import contextmanager
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class InFlight(object):
+    """
+    A call that other requests may be waiting on
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer(object):
+    def __init__(self, lock_dir, timeout=30, poll_interval=0.05):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Return ``func(*args, **kwargs)``, or the result of the call already in
+        flight for ``key``.
+
+        Raises ``LockTimeout`` if the result isn't ready within ``timeout``
+        seconds. Exceptions raised by ``func`` are raised for every request
+        that waited on it.
+        """
+        with self.lock:
+            call = self.in_flight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.in_flight[key] = InFlight()
+
+        if not is_leader:
+            if not call.done.wait(self.timeout):
+                raise LockTimeout("Timed out waiting for %s" % key)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with self.file_lock(key):
+                call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call.done.set()
+        return call.result
+
+    def get_lock_path(self, key):
+        return os.path.join(self.lock_dir, sha1(key).hexdigest())
+
+    @contextmanager
+    def file_lock(self, key):
+        """
+        Hold an exclusive lock for ``key`` that other processes respect.
+        """
+        lock_path = self.get_lock_path(key)
+        deadline = time.time() + self.timeout
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                self.wait_for_lock(fd, key, deadline)
+            except Exception:
+                os.close(fd)
+                raise
+            # The holder before us removes the lockfile, so if we were waiting
+            # on it, someone else may have locked a new one. Only the file
+            # still at lock_path counts.
+            if self.is_lockfile(fd, lock_path):
+                break
+            os.close(fd)
+        try:
+            yield
+        finally:
+            # Remove the lockfile while still holding the lock. Anyone still
+            # waiting on the old file opens the new one once they get it.
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def wait_for_lock(self, fd, key, deadline):
+        """
+        Lock the open file ``fd``, raising ``LockTimeout`` after ``deadline``
+        """
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if time.time() >= deadline:
+                    raise LockTimeout("Timed out waiting for %s" % key)
+                time.sleep(self.poll_interval)
+
+    def is_lockfile(self, fd, lock_path):
+        """
+        Return whether the open file ``fd`` is the file at ``lock_path``
+        """
+        try:
+            stat = os.stat(lock_path)
+        except OSError:
+            return False
+        fstat = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino)
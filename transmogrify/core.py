@@ -1,37 +1,136 @@
 import os
+import mimetypes
+import threading
+from collections import namedtuple, deque
+from multiprocessing.pool import ThreadPool
+from io import BytesIO
 from hashlib import sha1
 from PIL import Image
 import images2gif
 import optimize
+from filesystem import FileTooLarge, get_storage
+from processors import AutoCrop, Crop, Resample
+from writeback import get_writeback_queue
+
+# When decoding a JPEG at a reduced scale, keep it at least this many times
+# larger than the resized image, so the quality doesn't suffer.
+DRAFT_OVERSAMPLE = 3
+
+# Stands in for an image when working out sizes without any pixels
+Canvas = namedtuple('Canvas', ['size'])
+
+
+def fuse_geometry(size, plan):
+    """
+    Combine the crops and resizes at the start of ``plan`` into a single
+    resample of a region of the original, so no intermediate images are made.
+
+    ``size`` is the size of the original image, and ``plan`` a list of
+    (processor, arg) tuples. Returns a new plan.
+    """
+    canvas = Canvas(size)
+    region = (0, 0) + tuple(size)
+    fused = 0
+    resized = False
+    for processor, arg in plan:
+        box = processor.crop_box(canvas, arg)
+        if box is not None:
+            left, top, right, bottom = box
+            width, height = canvas.size
+            if left < 0 or top < 0 or right > width or bottom > height or left >= right or top >= bottom:
+                # PIL fills outside the image, which resample can't do
+                break
+            x_scale = (region[2] - region[0]) / float(width)
+            y_scale = (region[3] - region[1]) / float(height)
+            region = (
+                region[0] + left * x_scale,
+                region[1] + top * y_scale,
+                region[0] + right * x_scale,
+                region[1] + bottom * y_scale,
+            )
+            canvas = Canvas((right - left, bottom - top))
+        else:
+            new_size = processor.output_size(canvas, arg)
+            if new_size is None:
+                break
+            canvas = Canvas(new_size)
+            resized = True
+        fused += 1
+
+    if resized:
+        return [(Resample, (region, canvas.size))] + plan[fused:]
+    elif fused > 1:
+        # Only crops, so the region is still whole pixels
+        bbox = "-".join([str(int(x)) for x in region])
+        return [(Crop, bbox)] + plan[fused:]
+    return plan
+
+
+# Threads for processing the frames of animated GIFs, made as needed in each
+# process
+frame_pools = {}
+frame_pools_lock = threading.Lock()
+
+
+def get_frame_pool(workers):
+    """
+    Return this process's pool of ``workers`` threads.
+    """
+    key = (os.getpid(), workers)
+    with frame_pools_lock:
+        pool = frame_pools.get(key)
+        if pool is None:
+            pool = frame_pools[key] = ThreadPool(workers)
+        return pool
+
+
+def imap_ordered(pool, func, iterable, window):
+    """
+    Like ``pool.imap``, yield ``func(item)`` for each item in order, but
+    only take the next item when fewer than ``window`` are in progress.
+    Frames are then decoded only as fast as they are used.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item, )))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
 class Transmogrify(object):
     def __init__(self, path_and_query, server="", **kwargs):
         from .utils import process_url
+        from settings import PROCESSORS
 
         url_parts = process_url(path_and_query, server)
         original_file = url_parts['original_file']
         output_path, _ = os.path.split(url_parts['requested_file'])
 
-        if original_file.startswith('s3://'):
-            from filesystem import s3
-            self.im = Image.open(s3.get_file(original_file))
-        elif not os.path.exists(original_file) or not os.path.isfile(original_file):
+        self.original_storage = get_storage(original_file)
+        try:
+            original = self.original_storage.open(original_file)
+        except FileTooLarge:
+            raise
+        except IOError:
             # We shouldn't get here, as process_url should raise an Http404, but just in case...
             self.im = None  # pragma: no cover
         else:
-            self.im = Image.open(original_file)
+            self.im = Image.open(original)
         if self.im and 'duration' in self.im.info and self.im.format == 'GIF':
+            # The frames are read one at a time as they are rendered
             self.duration = int(self.im.info['duration']) / 1000.0
-            self.frames = images2gif.read_gif(original_file, True)
+            self.is_animated = getattr(self.im, 'is_animated', False)
         else:
             self.duration = None
-            self.frames = []
+            self.is_animated = False
         self.output_path = output_path
         self.original_file = original_file
         self.actions = url_parts['actions']
         self.quality = kwargs.get('quality', 80)
         self.filename = self.get_processed_filename()
+        self.storage = get_storage(self.filename)
 
         _, fmt = os.path.splitext(self.filename)
         fmt = fmt.lower().replace('.', '')
@@ -39,28 +138,71 @@ class Transmogrify(object):
             fmt = 'jpeg'
         self.format = fmt
 
-    def save(self):
+        self.plan = [(PROCESSORS[action], arg) for action, arg in self.actions]
+        if self.im is not None:
+            self.plan = fuse_geometry(self.im.size, self.plan)
+        self.draft()
+
+    def get_source_key(self):
+        """
+        Identify the original file and its current contents, for caching
+        things worked out from it. Returns None if that isn't possible.
+        """
+        stat = self.original_storage.stat(self.original_file)
+        if stat is None:
+            return None
+        return "%s:%s:%s" % (self.original_file, stat.mtime, stat.size)
+
+    def draft(self):
+        """
+        When the first step shrinks a JPEG, have the decoder scale it down by
+        1/2, 1/4 or 1/8 as it loads, instead of decoding every pixel.
+
+        The first step's region is scaled to match, so the result is the same
+        size either way.
+        """
+        if self.im is None or self.is_animated or self.im.format != 'JPEG' or not self.plan:
+            return
+        processor, arg = self.plan[0]
+        if processor is not Resample:
+            return
+        region, size = arg
+        original_size = self.im.size
+        region_width = float(region[2] - region[0])
+        region_height = float(region[3] - region[1])
+        draft_size = (
+            int(original_size[0] * max(size[0], 1) * DRAFT_OVERSAMPLE / region_width) + 1,
+            int(original_size[1] * max(size[1], 1) * DRAFT_OVERSAMPLE / region_height) + 1,
+        )
+        if original_size[0] < draft_size[0] * 2 or original_size[1] < draft_size[1] * 2:
+            # The decoder can't scale it down by at least half
+            return
+        self.im.draft(self.im.mode, draft_size)
+
+        # The decoder rounds the size up, so work out the scale it used
+        for scale in (8, 4, 2, 1):
+            if (original_size[0] + scale - 1) // scale == self.im.size[0]:
+                break
+        limits = self.im.size + self.im.size
+        region = tuple([min(x / float(scale), limit) for x, limit in zip(region, limits)])
+        self.plan[0] = (Resample, (region, size))
+
+    def render(self):
         """
         Apply a series of actions from a set of (action, arg) tuples, probably
         as parsed from a URL. Each action is a code into PROCESSORS.
 
-        Then save the mogrified image.
+        Returns the mogrified image encoded in the requested format.
         """
-        from settings import PROCESSORS
-        from .filesystem import makedirs
+        if self.is_animated:
+            return self.render_animation()
 
-        if self.im is None:
-            # If we got here something very strange is going on that I can't even
-            # predict.
-            return  # pragma: no cover
-        makedirs(self.output_path)
-        for action, arg in self.actions:
-            action = PROCESSORS[action]
-            if self.frames:
-                new_frames = []
-                for frame in self.frames:
-                    new_frames.append(action.process(frame, arg))
-                self.frames = new_frames
+        for index, (action, arg) in enumerate(self.plan):
+            if index == 0 and action is AutoCrop:
+                # Only the first step gets the original, so it may cache its
+                # gravity. Finding the key needs a stat, which is left until
+                # it's needed.
+                self.im = action.process(self.im, arg, cache_key=self.get_source_key())
             else:
                 self.im = action.process(self.im, arg)
 
@@ -74,21 +216,66 @@ class Transmogrify(object):
         if self.format == 'jpeg':
             kwargs['progressive'] = True
 
-        if self.filename.startswith('s3://'):
-            import cStringIO
-            from filesystem import s3
-            output = cStringIO.StringIO()
-            if self.frames:
-                images2gif.write_gif(output, self.frames)
-            else:
-                self.im.save(output, **kwargs)
-            output.reset()
-            s3.put_file(output, self.filename)
+        output = BytesIO()
+        self.im.save(output, **kwargs)
+        return output.getvalue()
+
+    def render_animation(self):
+        """
+        Apply the actions to each frame of an animated GIF in turn, encoding
+        each one before the next is read, so only a frame or two is ever in
+        memory.
+
+        Returns the mogrified animation encoded as a GIF.
+        """
+        from settings import GIF_SHARED_PALETTE, GIF_WORKERS
+
+        def process(item):
+            frame, duration, disposal = item
+            for action, arg in self.plan:
+                frame = action.process(frame, arg)
+            return frame, duration
+
+        if GIF_WORKERS > 1:
+            # The frames are still decoded, and written, one at a time
+            pool = get_frame_pool(GIF_WORKERS)
+            frames = imap_ordered(pool, process, images2gif.iter_frames(self.im), GIF_WORKERS * 2)
         else:
-            if self.frames:
-                images2gif.write_gif(self.filename, self.frames)
-            else:
-                self.im.save(self.filename, **kwargs)
+            frames = (process(item) for item in images2gif.iter_frames(self.im))
+
+        output = BytesIO()
+        # Transparent frames replace the last one, instead of only the changes
+        # being drawn on top of it
+        transparent = 'transparency' in self.im.info
+        images2gif.write_gif_stream(output, frames, sub_rectangles=not transparent,
+                                    shared_palette=GIF_SHARED_PALETTE)
+        return output.getvalue()
+
+    def save(self):
+        """
+        Render the mogrified image and save it, or queue it to be saved in the
+        background if WRITEBACK_QUEUE_SIZE is set.
+
+        Returns the encoded image, so it can be sent along to the client.
+        """
+        from settings import WRITEBACK_QUEUE_SIZE
+
+        if self.im is None:
+            # If we got here something very strange is going on that I can't even
+            # predict.
+            return  # pragma: no cover
+        data = self.render()
+        if WRITEBACK_QUEUE_SIZE:
+            get_writeback_queue().put(self.storage, self.output_path, self.filename, data)
+        else:
+            self.storage.makedirs(self.output_path)
+            self.storage.put(self.filename, data)
+        return data
+
+    @property
+    def mimetype(self):
+        mimetype, _ = mimetypes.guess_type(self.filename)
+        return mimetype or 'application/octet-stream'
 
     def get_processed_filename(self):
         parent_dir, filename = os.path.split(self.original_file)
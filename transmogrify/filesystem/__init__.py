@@ -1,41 +1,76 @@
 """
 Slight abstraction of the filesystem calls to allow for other types of storage
+
+Each kind of storage is a ``Storage`` backend, chosen by the scheme of the
+path's URI: ``s3://bucket/key`` is kept in S3, ``memory://path`` in memory,
+and plain paths on the local filesystem.
 """
-import os
+import threading
 
+from .base import FileTooLarge, Stat, Storage  # NOQA
+from .cache import CachedStorage
+from .local import LocalStorage
+from .memory import MemoryStorage
+
+
+def get_s3_storage():
+    from transmogrify.settings import ORIGINAL_CACHE_DIR, ORIGINAL_CACHE_SIZE
+    from .s3 import S3Storage
+    storage = S3Storage()
+    if ORIGINAL_CACHE_DIR:
+        storage = CachedStorage(storage, ORIGINAL_CACHE_DIR, ORIGINAL_CACHE_SIZE)
+    return storage
 
-def makedirs(dirname):
-    if dirname.startswith("s3://"):
-        # S3 will make the directories when we submit the file
-        return
-    else:
-        assert dirname.startswith("/"), "dirname must be absolute"
 
-    bits = dirname.split(os.sep)[1:]
+# The function to make the storage for each URI scheme
+STORAGE_BACKENDS = {
+    'file': LocalStorage,
+    'memory': MemoryStorage,
+    's3': get_s3_storage,
+}
 
-    root = "/"
+storages = {}
+storages_lock = threading.Lock()
 
-    for bit in bits:
-        root = os.path.join(root, bit)
 
-        if not os.path.lexists(root):
-            os.mkdir(root)
-        elif not os.path.isdir(root):
-            raise OSError("%s is exists, but is not a directory." % (root, ))
-        else:  # exists and is a dir
-            pass
+def get_scheme(path):
+    if '://' in path:
+        return path.split('://', 1)[0]
+    return 'file'
+
+
+def get_storage(path):
+    """
+    Return the storage for ``path``. Backends are made once, and shared.
+    """
+    scheme = get_scheme(path)
+    try:
+        return storages[scheme]
+    except KeyError:
+        pass
+    with storages_lock:
+        if scheme not in storages:
+            try:
+                backend = STORAGE_BACKENDS[scheme]
+            except KeyError:
+                raise ValueError("No storage for %s" % path)
+            storages[scheme] = backend()
+        return storages[scheme]
+
+
+def makedirs(dirname):
+    get_storage(dirname).makedirs(dirname)
 
 
 def file_exists(original_file):
     """
     Check to make sure the original file exists
     """
-    if original_file.startswith("s3://"):
-        from filesystem import s3
-        return s3.file_exists(original_file)
-    else:
-        if not os.path.exists(original_file):
-            return False
-        if not os.path.isfile(original_file):
-            return False
-    return True
+    return get_storage(original_file).exists(original_file)
+
+
+def get_file(path):
+    """
+    Return the contents of the file
+    """
+    return get_storage(path).read(path)
@@ -0,0 +1,93 @@
+"""
+The interface every storage backend provides
+"""
+from collections import namedtuple
+
+# What's known about a stored file. Backends that can't tell the mtime or
+# etag leave them as None.
+Stat = namedtuple('Stat', ['size', 'mtime', 'etag'])
+
+
+class FileTooLarge(IOError):
+    """
+    The file is larger than the ``MAX_ORIGINAL_SIZE`` setting allows.
+    """
+    pass
+
+
+def check_size(path, size):
+    """
+    Raise ``FileTooLarge`` if a file of ``size`` bytes is too large to open
+    """
+    from transmogrify.settings import MAX_ORIGINAL_SIZE
+    if MAX_ORIGINAL_SIZE and size > MAX_ORIGINAL_SIZE:
+        raise FileTooLarge("%s is %s bytes, more than %s" % (path, size, MAX_ORIGINAL_SIZE))
+
+
+class Storage(object):
+    """
+    Somewhere images are kept, addressed by the full path or URI of the file.
+    """
+    def exists(self, path):
+        """
+        Return whether there is a file at ``path``
+        """
+        return self.stat(path) is not None
+
+    def open(self, path):
+        """
+        Return a readable file-like object of the file at ``path``.
+
+        Raises ``IOError`` if there is no such file.
+        """
+        raise NotImplementedError
+
+    def read(self, path):
+        """
+        Return the contents of the file at ``path``
+        """
+        f = self.open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def stat(self, path):
+        """
+        Return the ``Stat`` of the file at ``path``, or ``None`` if there is
+        no such file.
+        """
+        raise NotImplementedError
+
+    def put(self, path, data):
+        """
+        Store ``data``, a string of bytes, as the file at ``path``. Readers
+        see either the old file or the whole of the new one.
+        """
+        raise NotImplementedError
+
+    def delete(self, path):
+        """
+        Remove the file at ``path``.
+        """
+        raise NotImplementedError
+
+    def get_pending(self, path):
+        """
+        Return the data being saved at ``path`` that can't be read back yet,
+        or ``None``. Storage that saves before ``put`` returns has none.
+        """
+        return None
+
+    def makedirs(self, dirname):
+        """
+        Make sure files can be put in ``dirname``. Most storage has no real
+        directories, so there is nothing to do.
+        """
+        pass
+
+    def abspath(self, path):
+        """
+        Return ``path`` normalized, for checking it is within a base path.
+        """
+        return path
@@ -0,0 +1,165 @@
+"""
+A cache on local disk of files kept in remote storage, so an original is
+downloaded once however many versions of it are made.
+
+Files are kept by their path and ETag, so a file that changes is downloaded
+again. The cache directory may be shared by every worker on the machine: files
+are put in place with a rename, and the least recently used are removed when
+the cache grows beyond its size.
+
+Each worker keeps a running total of the cache's size, found by looking
+through the cache once and added to as files are downloaded, so the cache is
+only looked through again when the total is over the size. Files downloaded by
+other workers are counted when that happens.
+"""
+import os
+import errno
+import shutil
+import logging
+import tempfile
+import threading
+from hashlib import sha1
+
+import daiquiri
+
+from .base import Storage, check_size
+
+daiquiri.setup(level=logging.INFO)
+logger = daiquiri.getLogger(__name__)
+
+
+class CachedStorage(Storage):
+    def __init__(self, storage, directory, max_size):
+        self.storage = storage
+        self.directory = directory
+        self.max_size = max_size
+        self.local = threading.local()
+        # Bytes in the cache, or None until the cache is first looked through
+        self.size = None
+        self.size_lock = threading.Lock()
+
+    def get_cache_path(self, path, etag):
+        key = sha1("%s\0%s" % (path, etag)).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def stat(self, path):
+        # Kept for the thread's next open, which needs the ETag
+        stat = self.storage.stat(path)
+        self.local.last_stat = (path, stat)
+        return stat
+
+    def open(self, path):
+        last_path, stat = getattr(self.local, 'last_stat', (None, None))
+        self.local.last_stat = (None, None)
+        if last_path != path or stat is None:
+            stat = self.storage.stat(path)
+        if stat is None:
+            raise IOError("No such file: %s" % path)
+        if not stat.etag:
+            return self.storage.open(path)
+        check_size(path, stat.size)
+
+        cache_path = self.get_cache_path(path, stat.etag)
+        try:
+            f = open(cache_path, 'rb')
+        except IOError:
+            pass
+        else:
+            # The modification time orders the files for removal
+            try:
+                os.utime(cache_path, None)
+            except OSError:
+                pass
+            return f
+
+        self.add(self.populate(cache_path, self.storage.open(path)))
+        try:
+            return open(cache_path, 'rb')
+        except IOError:
+            # Removed by another worker already
+            return self.storage.open(path)
+
+    def populate(self, cache_path, f):
+        """
+        Copy the file ``f`` into the cache as ``cache_path``, returning its
+        size
+        """
+        dirname = os.path.dirname(cache_path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Hidden until it's complete
+        tmp = tempfile.NamedTemporaryFile(dir=dirname, prefix='.', delete=False)
+        try:
+            try:
+                shutil.copyfileobj(f, tmp)
+                size = tmp.tell()
+            finally:
+                f.close()
+                tmp.close()
+            os.rename(tmp.name, cache_path)
+        except Exception:
+            os.remove(tmp.name)
+            raise
+        return size
+
+    def add(self, size):
+        """
+        Count ``size`` more bytes in the cache, and remove files if that makes
+        it too large
+        """
+        with self.size_lock:
+            if self.size is None:
+                # The file just added is counted by looking
+                self.evict()
+            else:
+                self.size += size
+                if self.size > self.max_size:
+                    self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache is no larger than
+        ``max_size`` bytes, and start counting its size again from there
+        """
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                cache_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(cache_path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, cache_path))
+                total += stat.st_size
+        files.sort()
+        for mtime, size, cache_path in files:
+            if total <= self.max_size:
+                break
+            logger.debug("Removing {0} from the cache".format(cache_path))
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
+
+    def put(self, path, data):
+        self.storage.put(path, data)
+
+    def get_pending(self, path):
+        return self.storage.get_pending(path)
+
+    def delete(self, path):
+        self.storage.delete(path)
+
+    def makedirs(self, dirname):
+        self.storage.makedirs(dirname)
+
+    def abspath(self, path):
+        return self.storage.abspath(path)
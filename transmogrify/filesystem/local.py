@@ -0,0 +1,84 @@
+"""
+Storage on the local filesystem
+"""
+import os
+import errno
+import binascii
+
+from .base import Stat, Storage
+
+
+class LocalStorage(Storage):
+    def __init__(self):
+        # Directories already made, or found, by this process
+        self.known_dirs = set()
+
+    def exists(self, path):
+        return os.path.isfile(path)
+
+    def open(self, path):
+        return open(path, 'rb')
+
+    def stat(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return Stat(stat.st_size, stat.st_mtime, None)
+
+    def put(self, path, data):
+        """
+        Write to a hidden file next to ``path``, and rename it into place, so
+        the file is never seen half written.
+        """
+        from transmogrify.settings import FSYNC_WRITES
+        dirname, filename = os.path.split(path)
+        tmp_path = os.path.join(dirname, '.%s.%s.%s' % (
+            filename, os.getpid(), binascii.hexlify(os.urandom(4))))
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno != errno.ENOENT or dirname not in self.known_dirs:
+                raise
+            # Removed since it was made
+            self.known_dirs.discard(dirname)
+            self.makedirs(dirname)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+                if FSYNC_WRITES:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        if FSYNC_WRITES:
+            # And the rename
+            fd = os.open(dirname or '.', os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def delete(self, path):
+        os.remove(path)
+
+    def makedirs(self, dirname):
+        assert dirname.startswith("/"), "dirname must be absolute"
+
+        if dirname in self.known_dirs:
+            return
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            # Made by someone else in the meantime is fine
+            if e.errno != errno.EEXIST or not os.path.isdir(dirname):
+                raise
+        self.known_dirs.add(dirname)
+
+    def abspath(self, path):
+        return os.path.abspath(path)
@@ -0,0 +1,44 @@
+"""
+Storage in memory, for tests and trying things out. Files are shared by every
+thread in the process, and lost when it exits.
+"""
+import time
+import threading
+from io import BytesIO
+from hashlib import md5
+
+from .base import Stat, Storage
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        with self.lock:
+            try:
+                data, stat = self.files[path]
+            except KeyError:
+                raise IOError("No such file: %s" % path)
+        return BytesIO(data)
+
+    def stat(self, path):
+        with self.lock:
+            try:
+                return self.files[path][1]
+            except KeyError:
+                return None
+
+    def put(self, path, data):
+        stat = Stat(len(data), time.time(), md5(data).hexdigest())
+        # Replaced whole, so it's never seen half written
+        with self.lock:
+            self.files[path] = (data, stat)
+
+    def delete(self, path):
+        with self.lock:
+            try:
+                del self.files[path]
+            except KeyError:
+                raise OSError("No such file: %s" % path)
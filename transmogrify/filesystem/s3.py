@@ -1,10 +1,79 @@
+import atexit
+import calendar
 import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
 import boto3
 import daiquiri
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from .base import Stat, Storage, check_size
 
 daiquiri.setup(level=logging.INFO)
 logger = daiquiri.getLogger(__name__)
 
+clients = {}
+clients_lock = threading.Lock()
+
+# Threads uploading in the background, when S3_ASYNC_UPLOAD is set
+upload_pools = {}
+upload_pools_lock = threading.Lock()
+
+# The data of this process's background uploads that haven't finished, by path
+uploading = {}
+uploading_lock = threading.Lock()
+
+# How the uploads went, for keeping an eye on
+stats = Counter()
+stats_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return this process's S3 client.
+
+    Making a client reads the credentials and configuration again, and each
+    client keeps its own pool of connections, so one is made per process and
+    shared by its threads.
+    """
+    pid = os.getpid()
+    client = clients.get(pid)
+    if client is None:
+        with clients_lock:
+            client = clients.get(pid)
+            if client is None:
+                from transmogrify.settings import S3_MAX_POOL_CONNECTIONS
+                config = Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+                client = clients[pid] = boto3.session.Session().client('s3', config=config)
+    return client
+
+
+def reset():
+    """
+    Forget the clients made so far. Call it from gunicorn's ``post_fork``
+    hook, for example, so a worker doesn't share connections with its parent.
+    """
+    global clients_lock
+    clients.clear()
+    clients_lock = threading.Lock()
+
+
+def _is_not_found(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def _is_changed(error):
+    return error.response.get('Error', {}).get('Code') in ('412', 'PreconditionFailed')
+
 
 def _parse_s3_file(original_file):
     """
@@ -18,61 +87,219 @@ def _parse_s3_file(original_file):
 
 def file_exists(original_file):
     """
-    Validate the original file is in the S3 bucket
+    Validate the original file is in the S3 bucket.
+
+    Returns the file's ``Stat``, which may be given to ``get_file``, or None
+    if it isn't there.
     """
-    s3 = boto3.resource('s3')
-    bucket_name, object_key = _parse_s3_file(original_file)
-    bucket = s3.Bucket(bucket_name)
-    bucket_iterator = bucket.objects.filter(Prefix=object_key)
-    bucket_list = [x for x in bucket_iterator]
-    logger.debug("Bucket List: {0}".format(", ".join([x.key for x in bucket_list])))
-    logger.debug("bucket_list length: {0}".format(len(bucket_list)))
-    return len(bucket_list) == 1
-    # if len(bucket_list) != 1:
-    #     # If the path is a directory, S3 doesn't return anything
-    #     logger.debug("bucket_list is not equal to 1 ({0})".format(len(bucket_list)))
-    #     return False
-    # return True
+    return stat_file(original_file)
 
 
 def callback(bytes):
     print bytes
 
 
-def get_file(original_file):
+def get_file(original_file, stat=None):
     """
     original file should be s3://bucketname/path/to/file.txt
 
-    returns a Buffer with the file in it
+    returns a file with the file in it. If the file's ``stat`` is known, the
+    file is only returned if it is still the same one.
+
+    Files larger than the ``S3_SPOOL_SIZE`` setting are written to disk as
+    they are downloaded, and files larger than ``MAX_ORIGINAL_SIZE`` aren't
+    downloaded at all.
     """
-    import cStringIO
-    import boto3
-    s3 = boto3.resource('s3')
+    from transmogrify.settings import S3_SPOOL_SIZE
     bucket_name, object_key = _parse_s3_file(original_file)
+    kwargs = {'Bucket': bucket_name, 'Key': object_key}
+    if stat is not None:
+        check_size(original_file, stat.size)
+        if stat.etag:
+            kwargs['IfMatch'] = stat.etag
     logger.debug("Downloading {0} from {1}".format(object_key, bucket_name))
-    bucket = s3.Bucket(bucket_name)
-    output = cStringIO.StringIO()
-    bucket.download_fileobj(object_key, output)
-    output.reset()
+    # One GET, where a managed download would ask for the size first
+    response = get_client().get_object(**kwargs)
+    body = response['Body']
+    try:
+        check_size(original_file, response['ContentLength'])
+        output = tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_SIZE)
+        for chunk in iter(lambda: body.read(64 * 1024), b''):
+            output.write(chunk)
+    finally:
+        body.close()
+    output.seek(0)
     return output
 
 
+def get_upload_args(modified_file):
+    """
+    The metadata of the object uploaded as modified_file: its Content-Type,
+    the CACHE_CONTROL setting's Cache-Control, and the S3_UPLOAD_ARGS setting.
+    """
+    from transmogrify.settings import CACHE_CONTROL, S3_UPLOAD_ARGS
+    extra_args = {}
+    file_type, _ = mimetypes.guess_type(modified_file)
+    if file_type:
+        extra_args['ContentType'] = file_type
+    if CACHE_CONTROL:
+        extra_args['CacheControl'] = CACHE_CONTROL
+    extra_args.update(S3_UPLOAD_ARGS)
+    return extra_args
+
+
 def put_file(buffer, modified_file):
     """
     write the buffer to modified_file.
 
     modified_file should be in the format 's3://bucketname/path/to/file.txt'
     """
-    import mimetypes
-    import boto3
-    file_type, _ = mimetypes.guess_type(modified_file)
-
-    s3 = boto3.resource('s3')
+    from transmogrify.settings import S3_MAX_CONCURRENCY, S3_MULTIPART_THRESHOLD
     bucket_name, object_key = _parse_s3_file(modified_file)
-    extra_args = {
-        'ACL': 'public-read',
-        'ContentType': file_type
-    }
-    bucket = s3.Bucket(bucket_name)
+    config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                            max_concurrency=S3_MAX_CONCURRENCY)
     logger.info("Uploading {0} to {1}".format(object_key, bucket_name))
-    bucket.upload_fileobj(buffer, object_key, ExtraArgs=extra_args)
+    get_client().upload_fileobj(buffer, bucket_name, object_key,
+                                ExtraArgs=get_upload_args(modified_file), Config=config)
+
+
+def upload(modified_file, data):
+    """
+    Upload the bytes ``data`` as modified_file, logging and counting how it
+    went
+    """
+    start = time.time()
+    try:
+        put_file(BytesIO(data), modified_file)
+    except Exception:
+        with stats_lock:
+            stats['failed'] += 1
+        logger.exception("Failed to upload {0}".format(modified_file))
+        raise
+    with stats_lock:
+        stats['uploaded'] += 1
+        stats['bytes'] += len(data)
+    logger.info("Uploaded {0} ({1} bytes in {2:.3f}s)".format(modified_file, len(data), time.time() - start))
+
+
+def upload_in_background(modified_file, data):
+    """
+    Upload the bytes ``data`` as modified_file in one of this process's
+    S3_ASYNC_UPLOAD threads. Failures are logged, and counted in ``stats``.
+    Until it finishes, ``get_pending`` returns the data.
+    """
+    from transmogrify.settings import S3_ASYNC_UPLOAD
+
+    def run():
+        try:
+            upload(modified_file, data)
+        except Exception:
+            pass
+        finally:
+            with uploading_lock:
+                if uploading.get(modified_file) is data:
+                    del uploading[modified_file]
+
+    key = (os.getpid(), S3_ASYNC_UPLOAD)
+    with upload_pools_lock:
+        pool = upload_pools.get(key)
+        if pool is None:
+            pool = upload_pools[key] = ThreadPool(S3_ASYNC_UPLOAD)
+        with stats_lock:
+            stats['queued'] += 1
+        with uploading_lock:
+            uploading[modified_file] = data
+        pool.apply_async(run)
+
+
+def get_pending(modified_file):
+    """
+    Return the data still being uploaded in the background as modified_file,
+    or ``None``
+    """
+    with uploading_lock:
+        return uploading.get(modified_file)
+
+
+@atexit.register
+def flush():
+    """
+    Wait for this process's background uploads to finish
+    """
+    pid = os.getpid()
+    with upload_pools_lock:
+        for key in [key for key in upload_pools if key[0] == pid]:
+            pool = upload_pools.pop(key)
+            pool.close()
+            pool.join()
+
+
+def stat_file(original_file):
+    """
+    Return the Stat of the object, or None if it doesn't exist
+    """
+    bucket_name, object_key = _parse_s3_file(original_file)
+    try:
+        response = get_client().head_object(Bucket=bucket_name, Key=object_key)
+    except ClientError as e:
+        if _is_not_found(e):
+            return None
+        raise
+    mtime = calendar.timegm(response['LastModified'].utctimetuple())
+    return Stat(response['ContentLength'], mtime, response['ETag'].strip('"'))
+
+
+def delete_file(modified_file):
+    """
+    Remove the object
+    """
+    bucket_name, object_key = _parse_s3_file(modified_file)
+    logger.info("Deleting {0} from {1}".format(object_key, bucket_name))
+    get_client().delete_object(Bucket=bucket_name, Key=object_key)
+
+
+class S3Storage(Storage):
+    """
+    Objects in S3. The ``Stat`` found by ``exists`` or ``stat`` is kept for
+    the thread's next ``open`` of the same object, so it opens the object
+    that was checked.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def remember(self, path, stat):
+        self.local.last_stat = (path, stat)
+        return stat
+
+    def exists(self, path):
+        return self.remember(path, file_exists(path)) is not None
+
+    def open(self, path):
+        last_path, stat = getattr(self.local, 'last_stat', (None, None))
+        self.local.last_stat = (None, None)
+        if last_path != path:
+            stat = None
+        try:
+            return get_file(path, stat)
+        except ClientError as e:
+            if _is_not_found(e):
+                raise IOError("No such file: %s" % path)
+            if stat is not None and _is_changed(e):
+                return get_file(path)
+            raise
+
+    def stat(self, path):
+        return self.remember(path, stat_file(path))
+
+    def put(self, path, data):
+        from transmogrify.settings import S3_ASYNC_UPLOAD
+        if S3_ASYNC_UPLOAD:
+            upload_in_background(path, data)
+        else:
+            upload(path, data)
+
+    def get_pending(self, path):
+        return get_pending(path)
+
+    def delete(self, path):
+        delete_file(path)
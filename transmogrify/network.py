@@ -1,5 +1,5 @@
-import os
 import urlparse
+from hashlib import sha1
 
 
 class Http404(Exception):
@@ -26,6 +26,7 @@ def handle_purge(environ, start_response):
     Handle a PURGE request.
     """
     from utils import is_valid_security, get_cached_files
+    from filesystem import get_storage
     from settings import DEBUG
     server = environ['SERVER_NAME']
     try:
@@ -36,7 +37,7 @@ def handle_purge(environ, start_response):
             cached_files = get_cached_files(path_and_query, server)
             for i in cached_files:
                 try:
-                    os.remove(i)
+                    get_storage(i).delete(i)
                 except OSError as e:
                     return do_500(environ, start_response, e.message)
             start_response("204 No Content", [])
@@ -54,6 +55,24 @@ def do_redirect(environ, start_response, path):
     return []
 
 
+def do_image(environ, start_response, body, content_type):
+    """
+    Send the image data directly, instead of redirecting to the cached file.
+    """
+    from settings import CACHE_CONTROL
+    headers = [
+        ("Content-Type", content_type),
+        ("Content-Length", str(len(body))),
+        ("ETag", '"%s"' % sha1(body).hexdigest()),
+    ]
+    if CACHE_CONTROL:
+        headers.append(("Cache-Control", CACHE_CONTROL))
+    start_response("200 OK", headers)
+    if environ.get('REQUEST_METHOD', 'GET') == 'HEAD':
+        return []
+    return [body]
+
+
 def do_500(environ, start_response, message):
     resp = {
         'message': message,
@@ -4,7 +4,26 @@ from PIL import ImageDraw
 from PIL import ImageFilter
 import re
 
+# The patterns of the processors' parameters, compiled once
+ANY_RE = re.compile(r'^(.*)$')
+EMPTY_RE = re.compile(r'^$')
 SIZE_RE = re.compile(r"^((\d+)|(x\d+)|(\d+x\d+))$")
+CROP_RE = re.compile((r"^((\d+)|(x\d+)|(\d+x\d+)"
+                      r"|(\d+)-(\d+)-(\d+)-(\d+))$"))
+LETTERBOX_RE = re.compile(r"^(\d+|x\d+|\d+x\d+)-([a-f0-9]+)$")
+BORDER_RE = re.compile(r"^(\d+)-([a-f0-9]+)$")
+
+
+def any_case(word):
+    """
+    A pattern matching ``word`` in upper or lower case. Unlike ``re.I``, it
+    can be combined with other patterns.
+    """
+    return "".join(["[%s%s]" % (c.lower(), c.upper()) if c.isalpha() else re.escape(c) for c in word])
+
+
+IMAGE_FILTERS = [o.lower() for o in dir(ImageFilter) if o == o.upper()]
+FILTER_RE = re.compile('^(%s)$' % ("|".join([any_case(f) for f in IMAGE_FILTERS])))
 
 __all__ = ["Thumbnail", "Crop", "ForceFit", "Resize", "LetterboxResize",
            "Border", "Filter", "Mask", "AutoCrop"]
@@ -20,12 +39,28 @@ class Processor(object):
 
     @staticmethod
     def param_pattern():
-        return re.compile(r'^(.*)$')
+        return ANY_RE
 
     @staticmethod
     def process(image, *args, **kwargs):
         return image
 
+    @staticmethod
+    def output_size(image, *args, **kwargs):
+        """
+        Return the (width, height) of the image ``process`` would return, if
+        all it does is resize the image. Otherwise return ``None``.
+        """
+        return None
+
+    @staticmethod
+    def crop_box(image, *args, **kwargs):
+        """
+        Return the (left, top, right, bottom) box ``process`` would return, if
+        all it does is crop the image. Otherwise return ``None``.
+        """
+        return None
+
     @staticmethod
     def parse_size(image, size):
         """
@@ -89,6 +124,22 @@ class Thumbnail(Processor):
         image.thumbnail((width, height), Image.ANTIALIAS)
         return image
 
+    @staticmethod
+    def output_size(image, size, *args, **kwargs):
+        """
+        The same calculation as PIL's ``thumbnail``: fit within the size, but
+        never get larger.
+        """
+        width, height = Thumbnail.parse_size(image, size)
+        x, y = image.size
+        if x > width:
+            y = int(max(y * width / x, 1))
+            x = int(width)
+        if y > height:
+            x = int(max(x * height / y, 1))
+            y = int(height)
+        return x, y
+
 
 class Crop(Processor):
     """
@@ -102,8 +153,7 @@ class Crop(Processor):
 
     @staticmethod
     def param_pattern():
-        return re.compile((r"^((\d+)|(x\d+)|(\d+x\d+)"
-                           r"|(\d+)-(\d+)-(\d+)-(\d+))$"))
+        return CROP_RE
 
     @staticmethod
     def process(image, size_or_bbox, *args, **kwargs):
@@ -114,17 +164,22 @@ class Crop(Processor):
 
     @staticmethod
     def crop_center(image, size, *args, **kwargs):
-        w, h = Crop.parse_size(image, size)
+        return image.crop(Crop.crop_box(image, size))
+
+    @staticmethod
+    def crop_bbox(image, bbox, *args, **kwargs):
+        return image.crop(Crop.crop_box(image, bbox))
+
+    @staticmethod
+    def crop_box(image, size_or_bbox, *args, **kwargs):
+        if "-" in size_or_bbox:
+            return tuple(map(int, size_or_bbox.split("-")))
+        w, h = Crop.parse_size(image, size_or_bbox)
         left = (image.size[0] - w) / 2
         top = (image.size[1] - h) / 2
         right = left + w
         bottom = top + h
-        return image.crop((left, top, right, bottom))
-
-    @staticmethod
-    def crop_bbox(image, bbox, *args, **kwargs):
-        bbox = map(int, bbox.split("-"))
-        return image.crop(bbox)
+        return (left, top, right, bottom)
 
 
 class ForceFit(Processor):
@@ -146,6 +201,10 @@ class ForceFit(Processor):
         w, h = ForceFit.parse_size(image, size)
         return image.resize((w, h), Image.ANTIALIAS)
 
+    @staticmethod
+    def output_size(image, size, *args, **kwargs):
+        return ForceFit.parse_size(image, size)
+
 
 class Resize(Processor):
     """
@@ -168,6 +227,29 @@ class Resize(Processor):
 
         return image.resize((img_width, img_height), Image.ANTIALIAS)
 
+    @staticmethod
+    def output_size(image, size, *args, **kwargs):
+        box_width, box_height = Resize.parse_size(image, size)
+        return Resize.smart_fit(image, box_width, box_height)
+
+
+class Resample(Processor):
+    """
+    Resize a region of the image in one step.
+
+    The param is a ((left, top, right, bottom), (width, height)) tuple. There
+    isn't a URL code for it; Transmogrify uses it to combine a chain of crops
+    and resizes.
+    """
+    @staticmethod
+    def process(image, box_and_size, *args, **kwargs):
+        box, size = box_and_size
+        return image.resize(size, Image.ANTIALIAS, box=box)
+
+    @staticmethod
+    def output_size(image, box_and_size, *args, **kwargs):
+        return box_and_size[1]
+
 
 class LetterboxResize(Processor):
     """
@@ -184,7 +266,7 @@ class LetterboxResize(Processor):
 
     @staticmethod
     def param_pattern():
-        return re.compile(r"^(\d+|x\d+|\d+x\d+)-([a-f0-9]+)$")
+        return LETTERBOX_RE
 
     @staticmethod
     def process(image, param_string, *args, **kwargs):
@@ -219,7 +301,7 @@ class Border(Processor):
 
     @staticmethod
     def param_pattern():
-        return re.compile(r"^(\d+)-([a-f0-9]+)$")
+        return BORDER_RE
 
     @staticmethod
     def process(image, param_string, *args, **kwargs):
@@ -260,8 +342,7 @@ class Filter(Processor):
 
     @staticmethod
     def param_pattern():
-        IMAGE_FILTERS = [o.lower() for o in dir(ImageFilter) if o == o.upper()]  # NOQA
-        return re.compile('^(%s)$' % ("|".join(IMAGE_FILTERS)), re.I)
+        return FILTER_RE
 
     @staticmethod
     def process(image, filter_name, *args, **kwargs):
@@ -293,7 +374,7 @@ class Mask(Processor):
 
     @staticmethod
     def param_pattern():
-        return re.compile(r'^$')
+        return EMPTY_RE
 
 
 class AutoCrop(Processor):
@@ -312,8 +393,10 @@ class AutoCrop(Processor):
     def process(image, size, *args, **kwargs):
         """
         Automatically crop the image based on image gravity and face detection
+
+        A ``cache_key`` identifying the image lets its gravity be cached.
         """
         from autodetect import smart_crop
         box_width, box_height = AutoCrop.parse_size(image, size)
-        scaled_size, rect = smart_crop(box_width, box_height, image.filename)
+        scaled_size, rect = smart_crop(box_width, box_height, image, kwargs.get('cache_key'))
         return image.resize(scaled_size, Image.ANTIALIAS).crop(tuple(rect))
@@ -1,24 +1,47 @@
 import os
 import logging
+import tempfile
+from collections import OrderedDict
 import processors
 import daiquiri
 
 DEFAULT_SETTINGS = {
     'BASE_PATH': "/home/media/",
+    'CACHE_CONTROL': "public, max-age=86400",
     'DEBUG': False,
     'EXTERNAL_PREFIX': "/external/",
+    'FACE_DETECTION_WIDTH': 800,
     'FALLBACK_SERVERS': (),
+    'FSYNC_WRITES': False,
+    'GIF_SHARED_PALETTE': 0,
+    'GIF_WORKERS': 1,
+    'GRAVITY_CACHE': "",
     'IMAGE_OPTIMIZATION_CMD': '',
+    'LOCK_DIR': tempfile.gettempdir(),
+    'LOCK_TIMEOUT': 30,
+    'MAX_ORIGINAL_SIZE': 0,
     'NO_IMAGE_URL': "",
     'OPENCV_PREFIX': '/usr/local/share/',
+    'ORIGINAL_CACHE_DIR': "",
+    'ORIGINAL_CACHE_SIZE': 1024 * 1024 * 1024,
     'ORIG_BASE_PATH': "/home/media/",
     'ORIG_PATH_HANDLER': None,
     'PATH_ALIASES': {},
+    'S3_ASYNC_UPLOAD': 0,
+    'S3_MAX_CONCURRENCY': 10,
+    'S3_MAX_POOL_CONNECTIONS': 10,
+    'S3_MULTIPART_THRESHOLD': 8 * 1024 * 1024,
+    'S3_SPOOL_SIZE': 10 * 1024 * 1024,
+    'S3_UPLOAD_ARGS': {'ACL': 'public-read'},
     'SECRET_KEY': "",
+    'STREAM_RESPONSE': False,
     'USE_VHOSTS': False,
     'VALID_DOMAINS': [],
     'VHOST_DOC_BASE': "",
     'VALID_IMAGE_EXTENSIONS': ['jpeg', 'jpg', 'gif', 'png', ],
+    'WRITEBACK_QUEUE_SIZE': 0,
+    'WRITEBACK_RETRIES': 3,
+    'WRITEBACK_WORKERS': 1,
     'ALLOWED_PROCESSORS': ['__all__', ],
     'CHECK_SECURITY': True,
 }
@@ -99,8 +122,10 @@ if "TRANSMOGRIFY_NO_IMG_URL" in os.environ:
     USER_SETTINGS['NO_IMAGE_URL'] = os.environ.get("TRANSMOGRIFY_NO_IMG_URL", "")
 
 # Environment path aliases should be
+#  pattern,replacement:pattern,replacement
+# and are tried in that order
 if "TRANSMOGRIFY_PATH_ALIASES" in os.environ:
-    USER_SETTINGS['PATH_ALIASES'] = dict(lists_from_env("TRANSMOGRIFY_PATH_ALIASES"))
+    USER_SETTINGS['PATH_ALIASES'] = OrderedDict(lists_from_env("TRANSMOGRIFY_PATH_ALIASES"))
 
 # Fallback Servers
 # Format is
@@ -127,6 +152,90 @@ if "TRANSMOGRIFY_ALLOWED_PROCESSORS" in os.environ:
 if "TRANSMOGRIFY_IMAGE_OPTIMIZATION_CMD" in os.environ:
     USER_SETTINGS['IMAGE_OPTIMIZATION_CMD'] = list_from_env("TRANSMOGRIFY_IMAGE_OPTIMIZATION_CMD")
 
+# Send the rendered image in the response instead of redirecting to it
+if "TRANSMOGRIFY_STREAM_RESPONSE" in os.environ:
+    USER_SETTINGS['STREAM_RESPONSE'] = bool_from_env("TRANSMOGRIFY_STREAM_RESPONSE", False)
+
+if "TRANSMOGRIFY_CACHE_CONTROL" in os.environ:
+    USER_SETTINGS['CACHE_CONTROL'] = os.environ.get("TRANSMOGRIFY_CACHE_CONTROL", "")
+
+# Where to keep the lockfiles for images being rendered
+if "TRANSMOGRIFY_LOCK_DIR" in os.environ:
+    USER_SETTINGS['LOCK_DIR'] = os.environ.get("TRANSMOGRIFY_LOCK_DIR", tempfile.gettempdir())
+
+# Seconds to wait on another request rendering the same image
+if "TRANSMOGRIFY_LOCK_TIMEOUT" in os.environ:
+    USER_SETTINGS['LOCK_TIMEOUT'] = float(os.environ.get("TRANSMOGRIFY_LOCK_TIMEOUT", 30))
+
+# SQLite database file caching the gravity of originals for automatic cropping
+if "TRANSMOGRIFY_GRAVITY_CACHE" in os.environ:
+    USER_SETTINGS['GRAVITY_CACHE'] = os.environ.get("TRANSMOGRIFY_GRAVITY_CACHE", "")
+
+# Face detection works on a copy of the image no wider than this
+if "TRANSMOGRIFY_FACE_DETECTION_WIDTH" in os.environ:
+    USER_SETTINGS['FACE_DETECTION_WIDTH'] = int(os.environ.get("TRANSMOGRIFY_FACE_DETECTION_WIDTH", 800))
+
+# Frames used to make one palette for all frames of animated GIFs, or 0
+if "TRANSMOGRIFY_GIF_SHARED_PALETTE" in os.environ:
+    USER_SETTINGS['GIF_SHARED_PALETTE'] = int(os.environ.get("TRANSMOGRIFY_GIF_SHARED_PALETTE", 0))
+
+# Threads processing the frames of each animated GIF
+if "TRANSMOGRIFY_GIF_WORKERS" in os.environ:
+    USER_SETTINGS['GIF_WORKERS'] = int(os.environ.get("TRANSMOGRIFY_GIF_WORKERS", 1))
+
+# Connections each process keeps open to S3
+if "TRANSMOGRIFY_S3_MAX_POOL_CONNECTIONS" in os.environ:
+    USER_SETTINGS['S3_MAX_POOL_CONNECTIONS'] = int(os.environ.get("TRANSMOGRIFY_S3_MAX_POOL_CONNECTIONS", 10))
+
+# Originals larger than this many bytes aren't downloaded, or 0 for no limit
+if "TRANSMOGRIFY_MAX_ORIGINAL_SIZE" in os.environ:
+    USER_SETTINGS['MAX_ORIGINAL_SIZE'] = int(os.environ.get("TRANSMOGRIFY_MAX_ORIGINAL_SIZE", 0))
+
+# Originals downloaded from S3 larger than this many bytes are kept on disk
+if "TRANSMOGRIFY_S3_SPOOL_SIZE" in os.environ:
+    USER_SETTINGS['S3_SPOOL_SIZE'] = int(os.environ.get("TRANSMOGRIFY_S3_SPOOL_SIZE", 10 * 1024 * 1024))
+
+# Directory caching the originals downloaded from S3
+if "TRANSMOGRIFY_ORIGINAL_CACHE_DIR" in os.environ:
+    USER_SETTINGS['ORIGINAL_CACHE_DIR'] = os.environ.get("TRANSMOGRIFY_ORIGINAL_CACHE_DIR", "")
+
+# Bytes of originals kept in the cache
+if "TRANSMOGRIFY_ORIGINAL_CACHE_SIZE" in os.environ:
+    USER_SETTINGS['ORIGINAL_CACHE_SIZE'] = int(os.environ.get("TRANSMOGRIFY_ORIGINAL_CACHE_SIZE", 1024 * 1024 * 1024))
+
+# Threads uploading to S3 after the response, or 0 to upload before it
+if "TRANSMOGRIFY_S3_ASYNC_UPLOAD" in os.environ:
+    USER_SETTINGS['S3_ASYNC_UPLOAD'] = int(os.environ.get("TRANSMOGRIFY_S3_ASYNC_UPLOAD", 0))
+
+# Threads uploading the parts of each large file to S3
+if "TRANSMOGRIFY_S3_MAX_CONCURRENCY" in os.environ:
+    USER_SETTINGS['S3_MAX_CONCURRENCY'] = int(os.environ.get("TRANSMOGRIFY_S3_MAX_CONCURRENCY", 10))
+
+# Files larger than this many bytes are uploaded to S3 in parts
+if "TRANSMOGRIFY_S3_MULTIPART_THRESHOLD" in os.environ:
+    USER_SETTINGS['S3_MULTIPART_THRESHOLD'] = int(os.environ.get("TRANSMOGRIFY_S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+
+# The ACL of files uploaded to S3
+if "TRANSMOGRIFY_S3_ACL" in os.environ:
+    USER_SETTINGS['S3_UPLOAD_ARGS'] = dict(USER_SETTINGS['S3_UPLOAD_ARGS'], ACL=os.environ.get("TRANSMOGRIFY_S3_ACL"))
+
+# Rendered images each process may queue to save in the background, or 0 to
+# save them before responding
+if "TRANSMOGRIFY_WRITEBACK_QUEUE_SIZE" in os.environ:
+    USER_SETTINGS['WRITEBACK_QUEUE_SIZE'] = int(os.environ.get("TRANSMOGRIFY_WRITEBACK_QUEUE_SIZE", 0))
+
+# Times a failed background save is tried again
+if "TRANSMOGRIFY_WRITEBACK_RETRIES" in os.environ:
+    USER_SETTINGS['WRITEBACK_RETRIES'] = int(os.environ.get("TRANSMOGRIFY_WRITEBACK_RETRIES", 3))
+
+# Threads in each process saving images in the background
+if "TRANSMOGRIFY_WRITEBACK_WORKERS" in os.environ:
+    USER_SETTINGS['WRITEBACK_WORKERS'] = int(os.environ.get("TRANSMOGRIFY_WRITEBACK_WORKERS", 1))
+
+# Flush images saved to local files to disk before they are in place
+if "TRANSMOGRIFY_FSYNC_WRITES" in os.environ:
+    USER_SETTINGS['FSYNC_WRITES'] = bool_from_env("TRANSMOGRIFY_FSYNC_WRITES", False)
+
 PATH_ALIASES = {}
 
 # Fallback Servers
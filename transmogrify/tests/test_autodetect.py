@@ -0,0 +1,117 @@
+"""
+Test the automatic crop detection
+"""
+import os
+import threading
+
+from PIL import Image, ImageDraw
+
+from benchmarks.reference import energy_center_by_pixel
+from transmogrify import autodetect, settings
+
+
+def test_energy_center():
+    image = Image.new('L', (100, 50), 0)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((60, 10, 79, 29), fill=255)
+    del draw
+    x, y = autodetect.energy_center(image)
+    assert abs(x - 0.695) < 1e-9
+    assert abs(y - 0.39) < 1e-9
+
+    # No energy at all
+    assert autodetect.energy_center(Image.new('L', (100, 50), 0)) == (0.5, 0.5)
+
+
+def test_energy_center_matches_pixel_version():
+    img = Image.open(os.path.join(settings.ORIG_BASE_PATH, 'horiz_img.jpg'))
+    img = img.convert('L', (0.5, 0.419, 0.081, 0)).resize((200, 139))
+    expected = energy_center_by_pixel(img)
+    result = autodetect.energy_center(img)
+    assert abs(result[0] - expected[0]) < 1e-9
+    assert abs(result[1] - expected[1]) < 1e-9
+
+
+def test_smart_crop_from_image():
+    """
+    smart_crop works from an already opened image, which might not have a path
+    """
+    from io import BytesIO
+
+    img_path = os.path.join(settings.ORIG_BASE_PATH, 'horiz_img.jpg')
+    img = Image.open(BytesIO(open(img_path, 'rb').read()))
+    assert autodetect.smart_crop(100, 100, img) == autodetect.smart_crop(100, 100, img_path)
+
+
+def test_gravity_cache(tmpdir):
+    from transmogrify.autodetect.cache import GravityCache
+
+    cache = GravityCache(str(tmpdir.join('gravity.db')))
+    assert cache.get('horiz_img.jpg:1:2') is None
+    cache.set('horiz_img.jpg:1:2', (0.25, 0.75))
+    assert cache.get('horiz_img.jpg:1:2') == (0.25, 0.75)
+
+    # Shared with other connections
+    assert GravityCache(cache.path).get('horiz_img.jpg:1:2') == (0.25, 0.75)
+
+
+def test_smart_crop_uses_gravity_cache(tmpdir):
+    import mock
+
+    img_path = os.path.join(settings.ORIG_BASE_PATH, 'horiz_img.jpg')
+    with mock.patch.object(settings, 'GRAVITY_CACHE', str(tmpdir.join('gravity.db'))):
+        with mock.patch.object(autodetect, 'face_and_energy_detector',
+                               wraps=autodetect.face_and_energy_detector) as detector:
+            first = autodetect.smart_crop(100, 100, img_path, cache_key='horiz_img.jpg:1:2')
+            second = autodetect.smart_crop(300, 200, img_path, cache_key='horiz_img.jpg:1:2')
+            assert detector.call_count == 1
+            assert first == autodetect.smart_crop(100, 100, img_path)
+            assert second == autodetect.smart_crop(300, 200, img_path)
+
+
+def test_preload():
+    """
+    Preloading is safe, with or without OpenCV
+    """
+    autodetect.preload()
+    if autodetect.HAS_OPENCV:
+        assert autodetect.get_cascade() is autodetect.get_cascade()
+        assert not autodetect.get_cascade().idle.empty()
+
+
+def test_classifier_pool():
+    """
+    Threads detecting at once each get their own classifier
+    """
+    pool = autodetect.ClassifierPool(object)
+    held = threading.Event()
+    release = threading.Event()
+    classifiers = []
+
+    def detect():
+        with pool.classifier() as classifier:
+            classifiers.append(classifier)
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=detect)
+    thread.start()
+    held.wait()
+    with pool.classifier() as classifier:
+        assert classifier is not classifiers[0]
+    release.set()
+    thread.join()
+
+    # Both are kept for later
+    assert pool.idle.qsize() == 2
+
+
+def test_get_working_array():
+    img = Image.open(os.path.join(settings.ORIG_BASE_PATH, 'horiz_img.jpg'))
+    img_gray, scale = autodetect.get_working_array(img, 800)
+    assert img_gray.shape == (555, 800)
+    assert scale == 800 / 1024.0
+
+    img_gray, scale = autodetect.get_working_array(img, 2000)
+    assert img_gray.shape == (710, 1024)
+    assert scale == 1.0
@@ -105,7 +105,7 @@ class TestTransmogrify(unittest.TestCase):
         expected_square = (300, 300)
         expected_vert = (168, 300)
         expected_horiz = (300, 208)
-        # expected_animated = (300, 214)
+        expected_animated = (300, 214)
         transmog = Transmogrify(utils.generate_url(self.square_img, '_r300x300'), "")
         transmog.save()
         img = Image.open(transmog.get_processed_filename())
@@ -118,16 +118,18 @@ class TestTransmogrify(unittest.TestCase):
         transmog.save()
         img = Image.open(transmog.get_processed_filename())
         self.assertEqual(expected_horiz, img.size)
-        # transmog = Transmogrify(utils.generate_url(self.animated, '_r300x300'), "")
-        # transmog.save()
-        # img = Image.open(transmog.get_processed_filename())
-        # self.assertEqual(expected_animated, img.size)
+        transmog = Transmogrify(utils.generate_url(self.animated, '_r300x300'), "")
+        transmog.save()
+        img = Image.open(transmog.get_processed_filename())
+        self.assertEqual(expected_animated, img.size)
+        self.assertEqual(18, img.n_frames)
+        self.assertEqual(200, img.info['duration'])
 
     def test_resize(self):
         expected_square = (300, 300)
         expected_vert = (168, 300)
         expected_horiz = (300, 208)
-        # expected_animated = (300, 214)
+        expected_animated = (300, 214)
         transmog = Transmogrify(utils.generate_url(self.square_img, '_r300x300'), "")
         transmog.save()
         img = Image.open(transmog.get_processed_filename())
@@ -140,10 +142,10 @@ class TestTransmogrify(unittest.TestCase):
         transmog.save()
         img = Image.open(transmog.get_processed_filename())
         self.assertEqual(expected_horiz, img.size)
-        transmog = Transmogrify(utils.generate_url(self.horiz_img, '_r300x300'), "")
-        # transmog.save()
-        # img = Image.open(transmog.get_processed_filename())
-        # self.assertEqual(expected_animated, img.size)
+        transmog = Transmogrify(utils.generate_url(self.animated, '_r300x300'), "")
+        transmog.save()
+        img = Image.open(transmog.get_processed_filename())
+        self.assertEqual(expected_animated, img.size)
 
     def test_force_fit(self):
         expected_square = (300, 300)
@@ -213,6 +215,113 @@ class TestTransmogrify(unittest.TestCase):
         # img = Image.open(transmog.get_processed_filename())
         # self.assertEqual(expected_square, img.size)
 
+    def test_draft(self):
+        from PIL import ImageChops, ImageStat
+
+        for action in ('_r100', '_rx90', '_s120x80', '_t100x100'):
+            transmog = Transmogrify(utils.generate_url(self.square_img, action), "")
+            self.assertTrue(transmog.im.size[0] < 1135, action)
+            transmog.render()
+            img = transmog.im
+
+            code, arg = action[1], action[2:]
+            original = Image.open(get_test_filepath(self.square_img))
+            original.load()  # Decode it at full size
+            expected = settings.PROCESSORS[code].process(original, arg)
+            self.assertEqual(expected.size, img.size)
+            diff = ImageStat.Stat(ImageChops.difference(expected, img.convert(expected.mode)))
+            # Well under the error from encoding it as a JPEG
+            self.assertTrue(max(diff.mean) < 3, (action, diff.mean))
+
+        # Not shrinking enough to bother
+        transmog = Transmogrify(utils.generate_url(self.square_img, '_r1000'), "")
+        self.assertEqual((1135, 1134), transmog.im.size)
+
+    def test_fused_actions(self):
+        from PIL import ImageChops, ImageStat
+
+        action_strings = (
+            '_c0-0-1000-700_r800_t200',
+            '_c100-100-900-600_s300x300',
+            '_r500_c300x200',
+            '_t600_c0-0-400-300_rx100',
+            '_c800x600_c400x300',
+        )
+        for action_string in action_strings:
+            transmog = Transmogrify(utils.generate_url(self.horiz_img, action_string), "")
+            self.assertEqual(1, len(transmog.plan), action_string)
+            transmog.render()
+
+            expected = Image.open(get_test_filepath(self.horiz_img))
+            expected.load()
+            for code, arg in transmog.actions:
+                expected = settings.PROCESSORS[code].process(expected, arg)
+            self.assertEqual(expected.size, transmog.im.size, action_string)
+            diff = ImageStat.Stat(ImageChops.difference(expected, transmog.im))
+            self.assertTrue(max(diff.mean) < 3, (action_string, diff.mean))
+
+        # Crops outside of the image aren't combined
+        transmog = Transmogrify(utils.generate_url(self.horiz_img, '_c0-510-300-810_r100'), "")
+        self.assertEqual(2, len(transmog.plan))
+
+        # Anything after the crops and resizes runs as usual
+        transmog = Transmogrify(utils.generate_url(self.horiz_img, '_c0-0-1000-700_r300_b3-f00'), "")
+        self.assertEqual([processors.Resample, processors.Border], [p for p, arg in transmog.plan])
+
+    def test_autocrop(self):
+        expected_square = (100, 100)
+        transmog = Transmogrify(utils.generate_url(self.horiz_img, '_a100x100'), "")
+        transmog.save()
+        img = Image.open(transmog.get_processed_filename())
+        self.assertEqual(expected_square, img.size)
+
+        # After another action, so the image doesn't come from a file
+        transmog = Transmogrify(utils.generate_url(self.horiz_img, '_c0-0-800-600_a100x100'), "")
+        transmog.save()
+        img = Image.open(transmog.get_processed_filename())
+        self.assertEqual(expected_square, img.size)
+
+    def test_source_key_only_for_autocrop(self):
+        # Looking up the original's key costs a stat, which only AutoCrop uses
+        transmog = Transmogrify(utils.generate_url(self.horiz_img, '_r100x100'), "")
+        with mock.patch.object(transmog, 'get_source_key', wraps=transmog.get_source_key) as get_source_key:
+            transmog.render()
+        self.assertFalse(get_source_key.called)
+
+        transmog = Transmogrify(utils.generate_url(self.horiz_img, '_a100x100'), "")
+        with mock.patch.object(transmog, 'get_source_key', wraps=transmog.get_source_key) as get_source_key:
+            transmog.render()
+        self.assertEqual(get_source_key.call_count, 1)
+
+    def test_animated_workers(self):
+        """
+        Processing frames in threads gives the same animation
+        """
+        expected = Transmogrify(utils.generate_url(self.animated, '_r200x200'), "").render()
+        with mock.patch.object(settings, 'GIF_WORKERS', 3):
+            result = Transmogrify(utils.generate_url(self.animated, '_r200x200'), "").render()
+        self.assertEqual(expected, result)
+
+    def test_imap_ordered(self):
+        import time
+        import random
+        from transmogrify.core import get_frame_pool, imap_ordered
+
+        def func(item):
+            time.sleep(random.random() / 100)
+            return item * 2
+
+        def items():
+            for item in range(20):
+                # Fewer than the window are in progress
+                self.assertTrue(item - len(results) < 4)
+                yield item
+
+        results = []
+        for result in imap_ordered(get_frame_pool(3), func, items(), 4):
+            results.append(result)
+        self.assertEqual(results, [item * 2 for item in range(20)])
+
     def test_cropname(self):
         transmog = Transmogrify(utils.generate_url(self.horiz_img, '_c0-510-300-810'))
         transmog.cropname = "cropped"
@@ -453,11 +562,11 @@ class TestWSGIHandler(unittest.TestCase):
         reload(utils)
 
     def tearDown(self):
-        for filename in ["vert_img_r222.jpg", "vert_img-testcrop.jpg", ]:
+        for filename in ["vert_img_r222.jpg", "vert_img_r111.jpg", "vert_img-testcrop.jpg", ]:
             absfn = get_test_filepath(filename)
 
-        if os.path.exists(absfn):
-            os.remove(absfn)
+            if os.path.exists(absfn):
+                os.remove(absfn)
 
         reload(settings)
 
@@ -478,6 +587,26 @@ class TestWSGIHandler(unittest.TestCase):
                          resp.location)
         self.assertTrue(os.path.exists(get_test_filepath("vert_img_r222.jpg")))
 
+    def test_stream_response(self):
+        import hashlib
+
+        settings.STREAM_RESPONSE = True
+        security_hash = self.do_sha_hash("_r111")
+        req = Request.blank("/")
+        req.environ['SERVER_NAME'] = 'testserver'
+        req.environ['REQUEST_URI'] = "/vert_img_r111.jpg?" + security_hash
+
+        resp = req.get_response(wsgi_handler.app)
+        self.assertEqual("200 OK", resp.status)
+        self.assertEqual("image/jpeg", resp.content_type)
+        self.assertEqual(len(resp.body), resp.content_length)
+        self.assertEqual('"%s"' % hashlib.sha1(resp.body).hexdigest(), resp.headers['ETag'])
+        self.assertEqual(settings.CACHE_CONTROL, resp.headers['Cache-Control'])
+
+        cached_file = get_test_filepath("vert_img_r111.jpg")
+        self.assertTrue(os.path.exists(cached_file))
+        self.assertEqual(open(cached_file, 'rb').read(), resp.body)
+
     # def test_direct_mode(self):
     #     security_hash = self.do_sha_hash("_r222")
     #     qs = urllib.urlencode({"key": security_hash,
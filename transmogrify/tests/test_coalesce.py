@@ -0,0 +1,107 @@
+"""
+Test coalescing concurrent requests
+"""
+import os
+import time
+import fcntl
+import tempfile
+import threading
+
+import pytest
+
+from transmogrify.coalesce import Coalescer, LockTimeout
+
+
+def test_concurrent_calls_share_result():
+    coalescer = Coalescer(tempfile.gettempdir(), timeout=5)
+    calls = []
+    results = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        return "rendered"
+
+    def request():
+        results.append(coalescer.do('/horiz_img_r200.jpg', render))
+
+    threads = [threading.Thread(target=request) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == ["rendered"] * 5
+    assert not os.path.exists(coalescer.get_lock_path('/horiz_img_r200.jpg'))
+
+
+def test_errors_are_shared():
+    coalescer = Coalescer(tempfile.gettempdir(), timeout=5)
+    errors = []
+
+    def render():
+        time.sleep(0.2)
+        raise ValueError("bad image")
+
+    def request():
+        try:
+            coalescer.do('/horiz_img_r201.jpg', render)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=request) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 3
+
+
+def test_waits_for_other_process():
+    """
+    A lock held through another file descriptor acts like another worker
+    """
+    coalescer = Coalescer(tempfile.gettempdir(), timeout=0.2)
+    lock_path = coalescer.get_lock_path('/horiz_img_r202.jpg')
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        with pytest.raises(LockTimeout):
+            coalescer.do('/horiz_img_r202.jpg', lambda: "rendered")
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    assert coalescer.do('/horiz_img_r202.jpg', lambda: "rendered") == "rendered"
+
+
+def test_removed_lockfile_is_not_locked():
+    """
+    A worker that waited on a lockfile its holder then removed must not go
+    ahead while another worker holds the new one
+    """
+    coalescer = Coalescer(tempfile.gettempdir(), timeout=5)
+    lock_path = coalescer.get_lock_path('/horiz_img_r203.jpg')
+    old_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(old_fd, fcntl.LOCK_EX)
+    calls = []
+    thread = threading.Thread(target=coalescer.do, args=('/horiz_img_r203.jpg', lambda: calls.append(1)))
+    thread.start()
+    time.sleep(0.2)
+
+    # The holder finishes as file_lock does, and another worker locks a new file
+    os.remove(lock_path)
+    new_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(new_fd, fcntl.LOCK_EX)
+    fcntl.flock(old_fd, fcntl.LOCK_UN)
+    os.close(old_fd)
+    try:
+        thread.join(0.2)
+        assert thread.is_alive()
+        assert not calls
+    finally:
+        fcntl.flock(new_fd, fcntl.LOCK_UN)
+        os.close(new_fd)
+    thread.join()
+    assert calls == [1]
@@ -0,0 +1,314 @@
+"""
+Test the storage backends
+"""
+import os
+import tempfile
+from io import BytesIO
+
+import mock
+import pytest
+
+from transmogrify import filesystem, settings
+from transmogrify.core import Transmogrify
+from transmogrify.filesystem import LocalStorage, MemoryStorage, get_storage
+from transmogrify.utils import generate_url
+
+
+def test_get_storage():
+    assert isinstance(get_storage('/home/media/horiz_img.jpg'), LocalStorage)
+    assert isinstance(get_storage('memory://media/horiz_img.jpg'), MemoryStorage)
+    # Shared by every path using the scheme
+    assert get_storage('memory://media/') is get_storage('memory://other/')
+    with pytest.raises(ValueError):
+        get_storage('ftp://example.com/horiz_img.jpg')
+
+
+@pytest.mark.parametrize('storage, base', [
+    (LocalStorage(), None),
+    (MemoryStorage(), 'memory://media'),
+])
+def test_storage(storage, base, tmpdir):
+    base = base or str(tmpdir)
+    path = os.path.join(base, 'sub', 'horiz_img_r100.jpg')
+
+    assert not storage.exists(path)
+    assert storage.stat(path) is None
+    with pytest.raises(IOError):
+        storage.open(path)
+
+    storage.makedirs(os.path.dirname(path))
+    storage.put(path, b'image data')
+    assert storage.exists(path)
+    assert storage.read(path) == b'image data'
+    assert storage.stat(path).size == 10
+
+    storage.delete(path)
+    assert not storage.exists(path)
+    with pytest.raises(OSError):
+        storage.delete(path)
+
+
+def test_local_makedirs(tmpdir):
+    storage = LocalStorage()
+    path = str(tmpdir.join('a', 'b', 'c'))
+    storage.makedirs(path)
+    assert os.path.isdir(path)
+    # Again is fine, and doesn't look
+    with mock.patch('os.makedirs') as makedirs:
+        storage.makedirs(path)
+    assert not makedirs.called
+
+    # Made by someone else is fine
+    other = str(tmpdir.join('a', 'b', 'd'))
+    os.mkdir(other)
+    storage.makedirs(other)
+
+    tmpdir.join('file').write('')
+    with pytest.raises(OSError):
+        storage.makedirs(str(tmpdir.join('file', 'd')))
+    with pytest.raises(OSError):
+        storage.makedirs(str(tmpdir.join('file')))
+
+    # Made again if it's been removed since
+    os.rmdir(path)
+    storage.put(os.path.join(path, 'horiz_img.jpg'), b'image data')
+    assert storage.read(os.path.join(path, 'horiz_img.jpg')) == b'image data'
+
+
+@pytest.mark.parametrize('fsync', [False, True])
+def test_local_put_is_atomic(fsync, tmpdir):
+    storage = LocalStorage()
+    path = str(tmpdir.join('horiz_img_r100.jpg'))
+    storage.put(path, b'old data')
+    renames = []
+
+    def rename(src, dst):
+        # Written in full next to the file, and the old one still in place
+        assert os.path.dirname(src) == str(tmpdir)
+        assert open(src, 'rb').read() == b'new data'
+        assert open(dst, 'rb').read() == b'old data'
+        renames.append(dst)
+        os_rename(src, dst)
+
+    os_rename = os.rename
+    with mock.patch.object(settings, 'FSYNC_WRITES', fsync), mock.patch('os.rename', rename):
+        storage.put(path, b'new data')
+    assert renames == [path]
+    assert storage.read(path) == b'new data'
+    assert os.listdir(str(tmpdir)) == ['horiz_img_r100.jpg']
+
+    # Nothing is left behind when it fails
+    with mock.patch('os.rename', side_effect=OSError):
+        with pytest.raises(OSError):
+            storage.put(path, b'newer data')
+    assert storage.read(path) == b'new data'
+    assert os.listdir(str(tmpdir)) == ['horiz_img_r100.jpg']
+
+
+def test_save_to_memory():
+    with mock.patch.object(settings, 'BASE_PATH', 'memory://modified/'):
+        transmog = Transmogrify(generate_url('horiz_img.jpg', '_r100x100'), "")
+        data = transmog.save()
+    assert transmog.filename == 'memory://modified/horiz_img_r100x100.jpg'
+    assert filesystem.get_file(transmog.filename) == data
+    assert filesystem.file_exists(transmog.filename)
+
+
+def test_s3_client():
+    from transmogrify.filesystem import s3
+    s3.reset()
+    with mock.patch.object(settings, 'S3_MAX_POOL_CONNECTIONS', 4):
+        client = s3.get_client()
+    # Made once for each process
+    assert s3.get_client() is client
+    assert client.meta.config.max_pool_connections == 4
+    with mock.patch('os.getpid', return_value=-1):
+        assert s3.get_client() is not client
+    s3.reset()
+    assert s3.get_client() is not client
+
+
+def test_s3_storage():
+    import datetime
+    from botocore.stub import Stubber
+    from transmogrify.filesystem import s3
+    s3.reset()
+    stubber = Stubber(s3.get_client())
+    stubber.add_response('head_object', {
+        'ContentLength': 10,
+        'ETag': '"abc"',
+        'LastModified': datetime.datetime(2017, 1, 1),
+    }, {'Bucket': 'bucket', 'Key': 'media/horiz_img.jpg'})
+    stubber.add_client_error('head_object', '404', http_status_code=404)
+    stubber.add_response('delete_object', {}, {'Bucket': 'bucket', 'Key': 'media/horiz_img.jpg'})
+    storage = get_storage('s3://bucket/')
+    with stubber:
+        assert storage.stat('s3://bucket/media/horiz_img.jpg') == (10, 1483228800, 'abc')
+        assert storage.stat('s3://bucket/media/missing.jpg') is None
+        storage.delete('s3://bucket/media/horiz_img.jpg')
+    stubber.assert_no_pending_responses()
+    s3.reset()
+
+
+def test_s3_exists_and_open():
+    import datetime
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+    from transmogrify.filesystem import s3
+    s3.reset()
+    stubber = Stubber(s3.get_client())
+    key = {'Bucket': 'bucket', 'Key': 'media/img.jpg'}
+    head = {
+        'ContentLength': 10,
+        'ETag': '"abc"',
+        'LastModified': datetime.datetime(2017, 1, 1),
+    }
+    # A single HEAD, however many objects share the prefix
+    stubber.add_response('head_object', head, key)
+    stubber.add_response('head_object', head, key)
+    # Then the object that was checked
+    stubber.add_response('get_object', {'Body': StreamingBody(BytesIO(b'image data'), 10), 'ContentLength': 10}, dict(key, IfMatch='abc'))
+    # It changed since, so the new one is opened
+    stubber.add_client_error('get_object', 'PreconditionFailed', http_status_code=412)
+    stubber.add_response('get_object', {'Body': StreamingBody(BytesIO(b'new data'), 8), 'ContentLength': 8}, key)
+    stubber.add_client_error('head_object', '404', http_status_code=404)
+    stubber.add_client_error('get_object', 'NoSuchKey', http_status_code=404)
+    storage = s3.S3Storage()
+    with stubber:
+        assert s3.file_exists('s3://bucket/media/img.jpg') == (10, 1483228800, 'abc')
+        assert storage.exists('s3://bucket/media/img.jpg')
+        assert storage.read('s3://bucket/media/img.jpg') == b'image data'
+        storage.local.last_stat = ('s3://bucket/media/img.jpg', filesystem.Stat(10, 1483228800, 'abc'))
+        assert storage.read('s3://bucket/media/img.jpg') == b'new data'
+        assert not storage.exists('s3://bucket/media/img.jpg.bak')
+        with pytest.raises(IOError):
+            storage.open('s3://bucket/media/img.jpg.bak')
+    stubber.assert_no_pending_responses()
+    s3.reset()
+
+
+def test_s3_spool_and_size_limit():
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+    from transmogrify.filesystem import s3
+    s3.reset()
+    stubber = Stubber(s3.get_client())
+    for i in range(2):
+        stubber.add_response('get_object', {
+            'Body': StreamingBody(BytesIO(b'image data'), 10),
+            'ContentLength': 10,
+        }, {'Bucket': 'bucket', 'Key': 'media/img.jpg'})
+    with stubber:
+        with mock.patch.object(settings, 'S3_SPOOL_SIZE', 4):
+            # Written to disk once it's larger than the setting
+            with mock.patch('tempfile.SpooledTemporaryFile', wraps=tempfile.SpooledTemporaryFile) as spooled:
+                output = s3.get_file('s3://bucket/media/img.jpg')
+            spooled.assert_called_once_with(max_size=4)
+            assert output.read() == b'image data'
+
+        with mock.patch.object(settings, 'MAX_ORIGINAL_SIZE', 5):
+            # Refused before it's asked for
+            with pytest.raises(filesystem.FileTooLarge):
+                s3.get_file('s3://bucket/media/img.jpg', filesystem.Stat(10, None, 'abc'))
+            # Or before it's downloaded
+            with pytest.raises(filesystem.FileTooLarge):
+                s3.get_file('s3://bucket/media/img.jpg')
+    stubber.assert_no_pending_responses()
+    s3.reset()
+
+
+def test_cached_storage(tmpdir):
+    remote = MemoryStorage()
+    cache = filesystem.CachedStorage(remote, str(tmpdir), 25)
+    remote.put('memory://media/a.jpg', b'image a')
+
+    with mock.patch.object(remote, 'open', wraps=remote.open) as remote_open:
+        assert cache.exists('memory://media/a.jpg')
+        assert cache.read('memory://media/a.jpg') == b'image a'
+        assert cache.read('memory://media/a.jpg') == b'image a'
+        # Downloaded once
+        assert remote_open.call_count == 1
+
+        # Changed, so downloaded again
+        remote.put('memory://media/a.jpg', b'image a, changed')
+        assert cache.read('memory://media/a.jpg') == b'image a, changed'
+        assert remote_open.call_count == 2
+
+    # The least recently used file is removed to keep within the size
+    remote.put('memory://media/b.jpg', b'image b')
+    assert cache.read('memory://media/b.jpg') == b'image b'
+    cached = [f for _, _, files in os.walk(str(tmpdir)) for f in files]
+    assert len(cached) == 2
+
+    remote.delete('memory://media/b.jpg')
+    assert not cache.exists('memory://media/b.jpg')
+    with pytest.raises(IOError):
+        cache.open('memory://media/b.jpg')
+
+
+def test_cached_storage_size(tmpdir):
+    remote = MemoryStorage()
+    cache = filesystem.CachedStorage(remote, str(tmpdir), 25)
+    for name in 'abcd':
+        remote.put('memory://media/%s.jpg' % name, b'image %s' % name)
+
+    with mock.patch.object(cache, 'evict', wraps=cache.evict) as evict:
+        # Looked through once, to find the size
+        cache.read('memory://media/a.jpg')
+        assert evict.call_count == 1
+        assert cache.size == 7
+
+        # Then counted, until it's over the size
+        cache.read('memory://media/b.jpg')
+        cache.read('memory://media/c.jpg')
+        assert evict.call_count == 1
+        assert cache.size == 21
+        cache.read('memory://media/d.jpg')
+        assert evict.call_count == 2
+        assert cache.size == 21
+
+
+def test_s3_put():
+    from botocore.stub import ANY, Stubber
+    from transmogrify.filesystem import s3
+    s3.reset()
+    stubber = Stubber(s3.get_client())
+    for i in range(2):
+        stubber.add_response('put_object', {}, {
+            'Bucket': 'bucket',
+            'Key': 'modified/img_r100.jpg',
+            'Body': ANY,
+            'ACL': 'private',
+            'CacheControl': 'public, max-age=60',
+            'ContentType': 'image/jpeg',
+        })
+    storage = s3.S3Storage()
+    with stubber, mock.patch.object(settings, 'S3_UPLOAD_ARGS', {'ACL': 'private'}):
+        with mock.patch.object(settings, 'CACHE_CONTROL', 'public, max-age=60'):
+            uploaded = s3.stats['uploaded']
+            storage.put('s3://bucket/modified/img_r100.jpg', b'image data')
+            assert s3.stats['uploaded'] == uploaded + 1
+
+            # Finished later
+            with mock.patch.object(settings, 'S3_ASYNC_UPLOAD', 2):
+                storage.put('s3://bucket/modified/img_r100.jpg', b'image data')
+            s3.flush()
+            assert s3.stats['uploaded'] == uploaded + 2
+    stubber.assert_no_pending_responses()
+    s3.reset()
+
+
+def test_s3_pending_upload():
+    import threading
+    from transmogrify.filesystem import s3
+    allowed = threading.Event()
+    storage = s3.S3Storage()
+    with mock.patch.object(s3, 'upload', lambda modified_file, data: allowed.wait()):
+        with mock.patch.object(settings, 'S3_ASYNC_UPLOAD', 2):
+            storage.put('s3://bucket/modified/img_r100.jpg', b'image data')
+        assert storage.get_pending('s3://bucket/modified/img_r100.jpg') == b'image data'
+        assert storage.get_pending('s3://bucket/modified/img_r200.jpg') is None
+
+        allowed.set()
+        s3.flush()
+    assert storage.get_pending('s3://bucket/modified/img_r100.jpg') is None
@@ -0,0 +1,156 @@
+"""
+Test the animated GIF support
+"""
+import os
+from io import BytesIO
+
+import mock
+import numpy as np
+from PIL import Image
+
+from benchmarks.reference import ElementwiseNeuQuant
+from transmogrify import images2gif, settings
+
+
+def get_test_image(size=(160, 111)):
+    img = Image.open(os.path.join(settings.ORIG_BASE_PATH, 'horiz_img.jpg'))
+    return img.convert('RGBA').resize(size)
+
+
+def test_neuquant_matches_elementwise_version():
+    img = get_test_image()
+    expected = ElementwiseNeuQuant(img, samplefac=2)
+    result = images2gif.NeuQuant(img, samplefac=2)
+    assert (result.network == expected.network).all()
+    assert (result.colormap == expected.colormap).all()
+    assert (result.netindex == expected.netindex).all()
+
+
+def test_neuquant_small_sample():
+    """
+    Fewer samples than learning cycles still learns
+    """
+    img = get_test_image((32, 20))
+    assert images2gif.NeuQuant(img, samplefac=10).colormap.shape == (256, 4)
+
+
+def test_neuquant_quantize(capsys):
+    img = get_test_image()
+    nq = images2gif.NeuQuant(img, samplefac=2)
+    result = nq.quantize_without_scipy(img)
+    assert result.mode == 'P'
+    assert result.size == img.size
+
+    # Every pixel gets its closest palette color
+    px = np.asarray(img.convert('RGB')).reshape((-1, 3))
+    palette = np.asarray(result.getpalette()[:nq.NETSIZE * 3]).reshape((-1, 3))
+    indexes = np.asarray(result).reshape(-1)
+    for i in range(0, len(px), 97):
+        assert (palette[indexes[i]] == nq.convert(*px[i])).all()
+
+    assert capsys.readouterr()[0] == ''
+
+
+def palette_error(nq, img):
+    """
+    The mean distance between the image's colors and their palette colors
+    """
+    px = np.asarray(img.convert('RGB')).astype('float64')
+    quantized = np.asarray(nq.quantize_without_scipy(img).convert('RGB')).astype('float64')
+    return np.sqrt(((px - quantized) ** 2).sum(2)).mean()
+
+
+def test_neuquant_batches():
+    """
+    Learning in batches gives a palette within 5% as good as learning from
+    each sample in turn
+    """
+    img = get_test_image((512, 355))
+    expected = palette_error(images2gif.NeuQuant(img), img)
+    for batch_size in (16, 64):
+        assert palette_error(images2gif.NeuQuant(img, batch_size=batch_size), img) < expected * 1.05
+
+
+def test_write_gif_nq_batch():
+    batch_sizes = []
+    learn = images2gif.NeuQuant.learn
+
+    class NeuQuant(images2gif.NeuQuant):
+        # The class looks up its constants as NeuQuant, so it can't be a mock
+        def learn(self):
+            batch_sizes.append(self.batch_size)
+            learn(self)
+
+    img = get_test_image()
+    with mock.patch.object(images2gif, 'NeuQuant', NeuQuant):
+        images2gif.write_gif(BytesIO(), [img, img.rotate(180)], nq=10, nq_batch=64, sub_rectangles=False)
+        images2gif.write_gif_stream(BytesIO(), [(img, 0.1)], nq=10, nq_batch=16)
+    assert batch_sizes == [64, 64, 16]
+
+
+def test_iter_frames():
+    img = Image.open(os.path.join(settings.ORIG_BASE_PATH, 'animated.gif'))
+    frames = images2gif.iter_frames(img)
+    frame, duration, disposal = next(frames)
+    assert frame.mode == 'RGB'
+    assert frame.size == (1904, 1360)
+    assert duration == 0.2
+
+    # Frames are read as they are needed
+    assert img.tell() == 0
+    count = 1
+    for frame, duration, disposal in frames:
+        assert frame.size == (1904, 1360)
+        count += 1
+    assert count == 18
+
+
+def test_write_gif_stream():
+    img = Image.open(os.path.join(settings.ORIG_BASE_PATH, 'animated.gif'))
+    frames = [(frame.resize((95, 68)), duration) for frame, duration, _ in images2gif.iter_frames(img)]
+    output = BytesIO()
+    positions = []
+
+    def produce():
+        for frame in frames:
+            positions.append(output.tell())
+            yield frame
+
+    images2gif.write_gif_stream(output, produce())
+
+    # Each frame was written before the next was produced
+    assert positions == sorted(set(positions))
+
+    expected = BytesIO()
+    images2gif.write_gif(expected, [frame for frame, _ in frames], duration=[d for _, d in frames])
+    result = Image.open(BytesIO(output.getvalue()))
+    expected = Image.open(expected)
+    assert result.n_frames == 18
+    assert result.info['duration'] == 200
+    for index in range(18):
+        result.seek(index)
+        expected.seek(index)
+        assert result.convert('RGB').tobytes() == expected.convert('RGB').tobytes()
+
+
+def test_shared_palette():
+    img = Image.open(os.path.join(settings.ORIG_BASE_PATH, 'animated.gif'))
+    frames = [frame.resize((238, 170)) for frame, _, _ in images2gif.iter_frames(img)]
+
+    per_frame = BytesIO()
+    images2gif.write_gif_stream(per_frame, [(frame, 0.2) for frame in frames])
+    shared = BytesIO()
+    images2gif.write_gif_stream(shared, [(frame, 0.2) for frame in frames], shared_palette=5)
+    listed = BytesIO()
+    images2gif.write_gif(listed, frames, duration=0.2, shared_palette=5)
+
+    # Without local color tables
+    assert len(shared.getvalue()) < len(per_frame.getvalue()) - 17 * 768
+    assert len(listed.getvalue()) < len(per_frame.getvalue()) - 17 * 768
+
+    result = Image.open(BytesIO(shared.getvalue()))
+    assert result.n_frames == 18
+    for index, frame in enumerate(frames):
+        result.seek(index)
+        diff = np.asarray(result.convert('RGB')).astype('int32') - np.asarray(frame)
+        assert np.abs(diff).mean() < 3
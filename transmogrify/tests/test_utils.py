@@ -1,9 +1,57 @@
 """
 Test the utils
 """
+import os
+import re
+
+import mock
+import pytest
+
+from benchmarks.reference import FILENAMES, parse_action_tuples_by_token
 from transmogrify import utils
 
 
+@pytest.mark.parametrize('filename', FILENAMES)
+def test_parse_action_tuples(filename):
+    expected = parse_action_tuples_by_token(filename)
+    assert utils.parse_action_tuples(filename) == expected
+    # Again, from the cache
+    result = utils.parse_action_tuples(filename)
+    assert result == expected
+    # Without sharing the list
+    result[1].append(('r', '1'))
+    assert utils.parse_action_tuples(filename) == expected
+
+
+def test_compile_action_grammar():
+    from transmogrify import processors
+    grammar = utils.compile_action_grammar({'r': processors.Resize, 'f': processors.Filter})
+    assert grammar.match('r100x100')
+    assert grammar.match('fBlur')
+    assert not grammar.match('c100')
+    assert not grammar.match('r100x')
+
+    class Flagged(processors.Processor):
+        @staticmethod
+        def param_pattern():
+            return re.compile(r'^blur$', re.I)
+
+    with pytest.raises(ValueError):
+        utils.compile_action_grammar({'g': Flagged})
+
+
+def test_lru_cache():
+    cache = utils.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # b was used least recently
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
 def test_is_tool():
     assert utils.is_tool('date') is True
     assert utils.is_tool('foo') is False
@@ -45,3 +93,38 @@ def test_settings_stuff():
     assert settings.bool_from_env('FOO', '1')
     assert settings.list_from_env("FOO", '1,2,3,4') == ['1', '2', '3', '4']
     assert settings.lists_from_env("FOO", '1,2:3,4') == [['1', '2'], ['3', '4']]
+
+
+@pytest.mark.parametrize('aliases, expected', [
+    # Longest first
+    ({'^/media/': '/assets/', '^/media/images/': '/img/'}, '/img/sample.jpg'),
+    # In order
+    ([('^/media/', '/assets/'), ('^/media/images/', '/img/')], '/assets/images/sample.jpg'),
+    # With groups of their own
+    ([('^/(v)(\\d)/', '/old/'), ('^/(me)(dia)/', '/\\2/')], '/dia/images/sample.jpg'),
+    # Which can't be combined
+    ([('^/(me)\\1/', '/'), ('^/media/', '/assets/')], '/assets/images/sample.jpg'),
+    ([('^/a/(?P<rest>.*)', '/\\g<rest>'), ('^/media/(?P<rest>.*)', '/assets/\\g<rest>')],
+     '/assets/images/sample.jpg'),
+    ([('^/MEDIA/', '/'), ('(?i)^/media/', '/assets/')], '/assets/images/sample.jpg'),
+    ([('^/other/', '/')], '/media/images/sample.jpg'),
+    ({}, '/media/images/sample.jpg'),
+])
+def test_resolve_request_path(aliases, expected):
+    from transmogrify import settings
+    with mock.patch.object(settings, 'PATH_ALIASES', aliases):
+        assert utils.resolve_request_path('/media/images/sample.jpg') == expected
+        # Only the start of the path is matched
+        assert utils.resolve_request_path('/x/media/images/sample.jpg') == '/x/media/images/sample.jpg'
+
+
+def test_resolve_request_path_many_aliases():
+    from transmogrify import settings
+    # More groups than one pattern can hold
+    aliases = [('^/(p)(%d)/' % i, '/%d/' % i) for i in range(150)]
+    with mock.patch.object(settings, 'PATH_ALIASES', aliases):
+        rules, combined = utils.get_path_aliases()
+        assert len(combined) == 5
+        assert utils.resolve_request_path('/p3/sample.jpg') == '/3/sample.jpg'
+        assert utils.resolve_request_path('/p149/sample.jpg') == '/149/sample.jpg'
+        assert utils.resolve_request_path('/p150/sample.jpg') == '/p150/sample.jpg'
@@ -0,0 +1,115 @@
+"""
+Test saving rendered images in the background
+"""
+import threading
+
+import mock
+
+from transmogrify import filesystem, settings, writeback
+from transmogrify.core import Transmogrify
+from transmogrify.filesystem import MemoryStorage
+from transmogrify.utils import generate_url
+from transmogrify.writeback import WritebackQueue
+
+
+class SlowStorage(MemoryStorage):
+    """
+    Only saves once it's allowed to, and fails the first ``failures`` times
+    """
+    def __init__(self, failures=0):
+        super(SlowStorage, self).__init__()
+        self.failures = failures
+        self.allowed = threading.Event()
+
+    def put(self, path, data):
+        self.allowed.wait()
+        if self.failures:
+            self.failures -= 1
+            raise IOError("Couldn't save %s" % path)
+        super(SlowStorage, self).put(path, data)
+
+
+def test_queue_saves_in_background():
+    storage = SlowStorage()
+    queue = WritebackQueue(2)
+    queue.put(storage, 'memory://modified', 'memory://modified/a.jpg', b'image a')
+    assert queue.get_pending('memory://modified/a.jpg') == b'image a'
+    assert not storage.exists('memory://modified/a.jpg')
+
+    storage.allowed.set()
+    queue.flush()
+    assert storage.read('memory://modified/a.jpg') == b'image a'
+    assert queue.get_pending('memory://modified/a.jpg') is None
+
+
+def test_full_queue_waits():
+    storage = SlowStorage()
+    queue = WritebackQueue(1)
+    queue.put(storage, 'memory://modified', 'memory://modified/a.jpg', b'image a')
+    queue.put(storage, 'memory://modified', 'memory://modified/b.jpg', b'image b')
+
+    # The first is being saved, and the second is in the queue
+    thread = threading.Thread(target=queue.put, args=(storage, 'memory://modified', 'memory://modified/c.jpg', b'image c'))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    storage.allowed.set()
+    thread.join()
+    queue.flush()
+    assert storage.exists('memory://modified/c.jpg')
+
+
+def test_failed_saves_are_retried():
+    storage = SlowStorage(failures=2)
+    storage.allowed.set()
+    queue = WritebackQueue(2, retries=2, retry_delay=0.01)
+    queue.put(storage, 'memory://modified', 'memory://modified/a.jpg', b'image a')
+    queue.flush()
+    assert storage.read('memory://modified/a.jpg') == b'image a'
+
+    storage.failures = 3
+    queue.put(storage, 'memory://modified', 'memory://modified/b.jpg', b'image b')
+    queue.flush()
+    assert not storage.exists('memory://modified/b.jpg')
+
+
+def test_save_in_background():
+    with mock.patch.object(settings, 'BASE_PATH', 'memory://modified/'):
+        with mock.patch.object(settings, 'WRITEBACK_QUEUE_SIZE', 4):
+            transmog = Transmogrify(generate_url('horiz_img.jpg', '_r120x100'), "")
+            data = transmog.save()
+    writeback.flush()
+    assert filesystem.get_file(transmog.filename) == data
+
+
+def test_unsaved_images_are_streamed():
+    from webob import Request
+    from transmogrify import wsgi
+
+    storage = filesystem.get_storage('memory://modified/')
+    allowed = threading.Event()
+    put = storage.put
+
+    def slow_put(path, data):
+        allowed.wait()
+        put(path, data)
+
+    req = Request.blank("/")
+    req.environ['SERVER_NAME'] = 'testserver'
+    req.environ['REQUEST_URI'] = "/" + generate_url('horiz_img.jpg', '_r130x100')
+    with mock.patch.object(settings, 'BASE_PATH', 'memory://modified/'), \
+            mock.patch.object(settings, 'WRITEBACK_QUEUE_SIZE', 4), \
+            mock.patch.object(settings, 'STREAM_RESPONSE', False), \
+            mock.patch.object(storage, 'put', slow_put):
+        # Not saved yet, so it can't be redirected to
+        resp = req.get_response(wsgi.app)
+        assert resp.status == "200 OK"
+        assert resp.body
+
+        # Still waiting, so from the queue
+        assert req.get_response(wsgi.app).body == resp.body
+
+        allowed.set()
+        writeback.flush()
+        assert req.get_response(wsgi.app).status == "302 Found"
@@ -25,11 +25,49 @@ import urlparse
 from hashlib import sha1
 import subprocess
 import logging
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
 import daiquiri
 
 daiquiri.setup(level=logging.INFO)
 logger = daiquiri.getLogger(__name__)
 
+# The number of filenames whose actions are remembered
+PARSE_CACHE_SIZE = 1024
+
+
+class LRUCache(object):
+    """
+    A dict of at most ``size`` items, forgetting the least recently used.
+
+    Each item is stamped with a counter when it's used, so getting an item is
+    only a dict lookup. When the cache is full, the least recently used
+    quarter is forgotten at once.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.items = {}
+        self.clock = itertools.count()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        entry = self.items.get(key)
+        if entry is None:
+            return default
+        entry[1] = next(self.clock)
+        return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = [value, next(self.clock)]
+            excess = len(self.items) - (self.size - self.size // 4)
+            if len(self.items) > self.size:
+                oldest = heapq.nsmallest(excess, self.items.items(), key=lambda item: item[1][1])
+                for old_key, entry in oldest:
+                    del self.items[old_key]
+
 
 def is_tool(name):
     try:
@@ -49,6 +87,7 @@ def download_url(url, destination):
     Download an external URL to the destination
     """
     from settings import VALID_IMAGE_EXTENSIONS
+    from filesystem import get_storage
     base_name, ext = os.path.splitext(url)
     ext = ext.lstrip('.')
 
@@ -56,15 +95,59 @@ def download_url(url, destination):
         raise Exception("Invalid image extension")
 
     base_path, filename = os.path.split(destination)
-    os.makedirs(base_path)
-    urllib.urlretrieve(url, destination)
+    storage = get_storage(destination)
+    storage.makedirs(base_path)
+    response = urllib.urlopen(url)
+    try:
+        storage.put(destination, response.read())
+    finally:
+        response.close()
 
 
-def is_valid_actionstring(action_string):
+def compile_action_grammar(processors):
+    """
+    Combine the ``param_pattern`` of each of ``processors``, a dict of code
+    to processor, into one pattern matching any valid action string.
+    """
+    alternatives = []
+    for code, processor in sorted(processors.items()):
+        # Action strings are split into the first character and the rest
+        if len(code) != 1:
+            continue
+        pattern = processor.param_pattern()
+        if pattern.flags & ~re.UNICODE:
+            raise ValueError("The pattern for %s can't have flags" % code)
+        pattern = pattern.pattern
+        if pattern.startswith('^'):
+            pattern = pattern[1:]
+        if pattern.endswith('$'):
+            pattern = pattern[:-1]
+        alternatives.append("%s(?:%s)" % (re.escape(code), pattern))
+    return re.compile("^(?:%s)$" % "|".join(alternatives))
+
+
+# The grammar and parsed filenames for the current PROCESSORS
+action_parser = (None, None, None)
+
+
+def get_action_parser():
+    """
+    Return the action grammar, and the cache of parsed filenames, made once
+    for the PROCESSORS setting
+    """
+    global action_parser
     from settings import PROCESSORS
-    code, arg = action_string[0], action_string[1:]
 
-    return code in PROCESSORS and PROCESSORS[code].param_pattern().match(arg)
+    processors, grammar, cache = action_parser
+    if processors is not PROCESSORS:
+        grammar, cache = compile_action_grammar(PROCESSORS), LRUCache(PARSE_CACHE_SIZE)
+        action_parser = (PROCESSORS, grammar, cache)
+    return grammar, cache
+
+
+def is_valid_actionstring(action_string):
+    grammar, _ = get_action_parser()
+    return grammar.match(action_string)
 
 
 def create_securityhash(action_tuples):
@@ -107,21 +190,119 @@ def is_valid_security(action_tuples, security_hash):
         return create_securityhash(action_tuples) == security_hash
 
 
+# Patterns with backreferences can't be combined, as their groups are
+# renumbered
+BACKREFERENCE_RE = re.compile(r"\\\d|\(\?P=")
+
+# The most groups a pattern may have
+MAX_GROUPS = 100
+
+
+def compile_path_aliases(aliases):
+    """
+    Compile the PATH_ALIASES setting into a list of (pattern, replacement)
+    rules, in the order they are tried, and a list of patterns combining them.
+
+    A dict's aliases are tried longest first, other mappings and sequences
+    of pairs in their own order.
+
+    Each combined pattern is paired with a dict of its groups to the indexes
+    of the rules. When it matches, its ``lastindex`` is the group of the first
+    rule matching. The combined patterns are ``None`` if some aliases can't be
+    combined.
+    """
+    if isinstance(aliases, OrderedDict):
+        items = aliases.items()
+    elif isinstance(aliases, dict):
+        items = sorted(aliases.items(), key=lambda item: (-len(item[0]), item[0]))
+    else:
+        items = list(aliases)
+    rules = [(re.compile(pattern), replacement) for pattern, replacement in items]
+
+    combined = []
+    alternatives = []
+    groups = {}
+    group = 1
+    names = set()
+    for index, (pattern, replacement) in enumerate(rules):
+        if (pattern.flags & ~re.UNICODE or BACKREFERENCE_RE.search(pattern.pattern) or
+                pattern.groups + 1 >= MAX_GROUPS or names.intersection(pattern.groupindex)):
+            return rules, None
+        # Group names may only be used once in a pattern
+        names.update(pattern.groupindex)
+        if group + pattern.groups >= MAX_GROUPS:
+            combined.append((alternatives, groups))
+            alternatives, groups, group = [], {}, 1
+        # The group around each alternative closes last, so it's the lastindex
+        groups[group] = index
+        group += pattern.groups + 1
+        alternatives.append("(%s)" % pattern.pattern)
+    if alternatives:
+        combined.append((alternatives, groups))
+    try:
+        combined = [(re.compile("|".join(alternatives)), groups) for alternatives, groups in combined]
+    except re.error:
+        # Tried in turn after all
+        return rules, None
+    return rules, combined
+
+
+# The compiled rules for the current PATH_ALIASES
+path_aliases = (None, None)
+
+
+def get_path_aliases():
+    """
+    Return the compiled PATH_ALIASES setting, compiled once
+    """
+    global path_aliases
+    from settings import PATH_ALIASES
+
+    aliases, compiled = path_aliases
+    if aliases is not PATH_ALIASES:
+        compiled = compile_path_aliases(PATH_ALIASES)
+        path_aliases = (PATH_ALIASES, compiled)
+    return compiled
+
+
 def resolve_request_path(requested_uri):
     """
     Check for any aliases and alter the path accordingly.
 
     Returns resolved_uri
     """
-    from settings import PATH_ALIASES
-
-    for key, val in PATH_ALIASES.items():
-        if re.match(key, requested_uri):
-            return re.sub(key, val, requested_uri)
+    rules, combined = get_path_aliases()
+
+    if combined is not None:
+        for pattern, groups in combined:
+            match = pattern.match(requested_uri)
+            if match is not None:
+                pattern, replacement = rules[groups[match.lastindex]]
+                return pattern.sub(replacement, requested_uri)
+        return requested_uri
+
+    for pattern, replacement in rules:
+        if pattern.match(requested_uri):
+            return pattern.sub(replacement, requested_uri)
     return requested_uri
 
 
 def parse_action_tuples(filename):
+    grammar, cache = get_action_parser()
+    parsed = cache.get(filename)
+    if parsed is None:
+        parsed = parse_action_string(filename, grammar)
+        cache.set(filename, parsed)
+    base_file_name, action_tuples = parsed
+    return base_file_name, list(action_tuples)
+
+
+def parse_action_string(filename, grammar):
+    """
+    Split the actions matching ``grammar`` off the end of ``filename``.
+
+    Returns the rest of the filename, and a tuple of (code, arg) tuples.
+    """
     base_filename, ext = os.path.splitext(filename)
 
     action_tuples = []
@@ -131,7 +312,7 @@ def parse_action_tuples(filename):
         action = bits.pop()
         if len(action) < 1:
             continue
-        if is_valid_actionstring(action):
+        if grammar.match(action):
             action_tuples.insert(0, (action[0], action[1:]))
             if bits and bits[-1] == '_':
                 bits.pop()  # pop the remaining underscore off the stack
@@ -141,7 +322,7 @@ def parse_action_tuples(filename):
 
     base_file_name = "".join(bits)
 
-    return base_file_name, action_tuples
+    return base_file_name, tuple(action_tuples)
 
 
 def process_url(url, server_name="", document_root=None, check_security=True):
@@ -164,6 +345,7 @@ def process_url(url, server_name="", document_root=None, check_security=True):
     The ``document_root`` parameter overrides the ``BASE_PATH`` setting.
     """
     from .network import Http404
+    from filesystem import get_storage
     from settings import (BASE_PATH, ORIG_BASE_PATH, USE_VHOSTS, VHOST_DOC_BASE, EXTERNAL_PREFIX)
 
     try:
@@ -193,10 +375,7 @@ def process_url(url, server_name="", document_root=None, check_security=True):
         requested_path = os.path.join(*parts)
     else:
         path = os.path.join(base_path, resolved_uri)
-        if base_path.startswith('s3://'):
-            requested_path = path
-        else:
-            requested_path = os.path.abspath(path)
+        requested_path = get_storage(base_path).abspath(path)
 
     if not requested_path.startswith(base_path):
         # Apparently, there was an attempt to put some directory traversal
@@ -216,11 +395,7 @@ def process_url(url, server_name="", document_root=None, check_security=True):
     base_uri = os.path.dirname(resolved_uri)
     original_uri = urlparse.urljoin(base_uri, base_filename + ext)
 
-    if original_file.startswith(u's3://'):
-        from filesystem import s3
-        original_is_missing = not s3.file_exists(original_file)
-    else:
-        original_is_missing = not os.path.exists(original_file)
+    original_is_missing = not get_storage(original_file).exists(original_file)
 
     if original_is_missing and is_external:
         try:
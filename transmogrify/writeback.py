@@ -0,0 +1,120 @@
+"""
+Save rendered images in the background, so the response doesn't wait for them
+to be written.
+
+Each process has a bounded queue of images to save, and threads saving them.
+When the queue is full, saving waits for room, so a slow storage backend slows
+the requests down instead of growing the queue without end. Failed saves are
+tried again, and the queue is flushed before the process exits.
+"""
+import os
+import time
+import Queue
+import atexit
+import logging
+import threading
+
+import daiquiri
+
+daiquiri.setup(level=logging.INFO)
+logger = daiquiri.getLogger(__name__)
+
+
+class WritebackQueue(object):
+    def __init__(self, size, workers=1, retries=3, retry_delay=1):
+        self.queue = Queue.Queue(size)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run, name="writeback-%s" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, storage, dirname, path, data):
+        """
+        Save ``data`` as the file at ``path`` in ``storage``, making
+        ``dirname`` first. Waits while the queue is full.
+        """
+        with self.lock:
+            self.pending[path] = data
+        self.queue.put((storage, dirname, path, data))
+
+    def get_pending(self, path):
+        """
+        Return the data waiting to be saved at ``path``, or ``None``
+        """
+        with self.lock:
+            return self.pending.get(path)
+
+    def run(self):
+        while True:
+            storage, dirname, path, data = self.queue.get()
+            try:
+                self.save(storage, dirname, path, data)
+            finally:
+                with self.lock:
+                    if self.pending.get(path) is data:
+                        del self.pending[path]
+                self.queue.task_done()
+
+    def save(self, storage, dirname, path, data):
+        for attempt in range(self.retries + 1):
+            try:
+                storage.makedirs(dirname)
+                storage.put(path, data)
+                return True
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception("Failed to save {0}".format(path))
+                    return False
+                logger.warning("Failed to save {0}, trying again".format(path))
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def flush(self):
+        """
+        Wait for everything in the queue to be saved
+        """
+        self.queue.join()
+
+
+queues = {}
+queues_lock = threading.Lock()
+
+
+def get_writeback_queue():
+    """
+    Return this process's queue, made from the WRITEBACK_ settings
+    """
+    from transmogrify.settings import WRITEBACK_QUEUE_SIZE, WRITEBACK_RETRIES, WRITEBACK_WORKERS
+    pid = os.getpid()
+    with queues_lock:
+        queue = queues.get(pid)
+        if queue is None:
+            queue = queues[pid] = WritebackQueue(WRITEBACK_QUEUE_SIZE, WRITEBACK_WORKERS, WRITEBACK_RETRIES)
+        return queue
+
+
+def get_pending(path):
+    """
+    Return the data waiting in this process's queue to be saved at ``path``,
+    or ``None``
+    """
+    queue = queues.get(os.getpid())
+    if queue is None:
+        return None
+    return queue.get_pending(path)
+
+
+@atexit.register
+def flush():
+    """
+    Wait for this process's queue to be saved. Call it from gunicorn's
+    ``worker_exit`` hook, for example.
+    """
+    queue = queues.get(os.getpid())
+    if queue is not None:
+        queue.flush()
@@ -4,26 +4,61 @@
 WSGI handler for mogrifying images.
 """
 
-import os
-from hashlib import sha1
-from contextlib import contextmanager
 from .core import Transmogrify
-from .network import Http404, do_404, handle_purge, do_redirect, get_path
+from .coalesce import Coalescer, LockTimeout
+from .filesystem import FileTooLarge
+from .network import Http404, do_404, handle_purge, do_redirect, do_image, get_path
+from .writeback import get_pending
 
+coalescer = None
 
-@contextmanager
-def lock_file(lock):
-    open(lock, "w")
 
-    try:
-        yield
-    finally:
-        # Remove lockfile
-        os.remove(lock)
+def get_coalescer():
+    global coalescer
+    from settings import LOCK_DIR, LOCK_TIMEOUT
+
+    if coalescer is None:
+        coalescer = Coalescer(LOCK_DIR, LOCK_TIMEOUT)
+    return coalescer
+
+
+def get_unsaved(new_file):
+    """
+    Return the image, if it's been rendered but isn't saved yet, or ``None``.
+    It may be waiting to be written back, or still uploading.
+    """
+    body = get_pending(new_file.filename)
+    if body is None:
+        body = new_file.storage.get_pending(new_file.filename)
+    return body
+
+
+def render(path_and_query, server):
+    """
+    Render the requested image, unless another worker already did while we
+    were waiting.
+
+    Returns the mimetype and the image data, if it is needed for the response:
+    when STREAM_RESPONSE is on, or the image isn't saved yet so it can't be
+    redirected to.
+    """
+    from settings import STREAM_RESPONSE
+
+    new_file = Transmogrify(path_and_query, server)
+    body = get_unsaved(new_file)
+    if body is not None:
+        pass
+    elif not new_file.storage.exists(new_file.filename):
+        body = new_file.save()
+        if not STREAM_RESPONSE and get_unsaved(new_file) is None:
+            body = None
+    elif STREAM_RESPONSE:
+        body = new_file.storage.read(new_file.filename)
+    return new_file.mimetype, body
 
 
 def app(environ, start_response):
-    from settings import DEBUG
+    from settings import DEBUG, STREAM_RESPONSE
 
     request_uri = get_path(environ)
     path_and_query = request_uri.lstrip('/')
@@ -33,20 +68,19 @@ def app(environ, start_response):
     if environ.get('REQUEST_METHOD', 'GET') == 'PURGE':
         return handle_purge(environ, start_response)
 
-    # Acquire lockfile
-    lock = '/tmp/%s' % sha1(path_and_query).hexdigest()
-    if os.path.isfile(lock):
+    try:
+        server = environ['SERVER_NAME']
+        mimetype, body = get_coalescer().do(path_and_query, render, path_and_query, server)
+    except Http404 as e:
+        return do_404(environ, start_response, e.message, DEBUG)
+    except LockTimeout:
         return do_404(environ, start_response, "File is being processed", DEBUG)
+    except FileTooLarge:
+        return do_404(environ, start_response, "Original file is too large", DEBUG)
 
-    with lock_file(lock):
-        try:
-            server = environ['SERVER_NAME']
-            new_file = Transmogrify(path_and_query, server)
-            new_file.save()
-        except Http404 as e:
-            return do_404(environ, start_response, e.message, DEBUG)
-
-        return do_redirect(environ, start_response, request_uri)
+    if STREAM_RESPONSE or body is not None:
+        return do_image(environ, start_response, body, mimetype)
+    return do_redirect(environ, start_response, request_uri)
 
 
 if __name__ == '__main__':